@@ -0,0 +1,234 @@
+import asyncio
+import json
+from contextlib import aclosing, asynccontextmanager
+from timeit import default_timer as timer
+
+from decouple import config
+from pydantic import BaseModel, ValidationError
+from starlette.applications import Starlette
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from cancellation import CancelToken, get_metrics, record
+from datasets import close_datasets, enabled_datasets, open_datasets
+from plan import VisualizationPlan, VisualizationTask
+from routing import ModelRouter
+import visualization
+
+# Run with several worker processes, e.g. `uvicorn api:app --workers 4`. Each worker
+# opens its own read-only DuckDB connections, which DuckDB allows across processes.
+# One worker serves every dataset in DATASETS, see datasets.py.
+
+# With WARM_UP off the worker is ready sooner and the first requests pay for the
+# imports and cold reads instead
+WARM_UP = config("WARM_UP", default=True, cast=bool)
+
+datasets = {}
+clients = {}
+# Shared by every dataset, so each model's latency and errors include all its requests
+router = ModelRouter()
+
+
+def get_async_client():
+    if "openai" not in clients:
+        import instructor
+        from openai import AsyncOpenAI
+
+        clients["openai"] = instructor.from_openai(AsyncOpenAI(api_key=config("OPENAI_API_KEY")))
+    return clients["openai"]
+
+
+class PlanRequest(BaseModel):
+    question: str
+
+
+@asynccontextmanager
+async def lifespan(app):
+    start = timer()
+    # The schemas do not change while the service runs, so describe them once per worker
+    datasets.update(open_datasets(enabled_datasets(), warm=WARM_UP))
+    if WARM_UP:
+        visualization.warm_up()
+        get_async_client()
+    print(f"Opened {', '.join(datasets) or 'no datasets'} in {round(timer() - start, 2)} seconds")
+    yield
+    close_datasets(datasets)
+
+
+def get_dataset(request):
+    return datasets.get(request.path_params["dataset"])
+
+
+def not_found(request):
+    return JSONResponse({"error": f"Unknown dataset {request.path_params['dataset']!r}"}, status_code=404)
+
+
+async def parse_body(request, model):
+    try:
+        return model.model_validate(await request.json())
+    except (ValidationError, ValueError) as e:
+        return JSONResponse({"error": str(e)}, status_code=422)
+
+
+def ndjson(obj):
+    return json.dumps(obj, default=str) + "\n"
+
+
+async def cancelling(token, lines):
+    """
+    Streams `lines` and cancels `token` if the response ends early, which is how
+    a client disconnect reaches the LLM stream and the running queries.
+    """
+    finished = False
+    try:
+        async with aclosing(lines):
+            async for line in lines:
+                yield line
+        finished = True
+    finally:
+        if not finished and token.cancel():
+            record("runs_cancelled")
+
+
+@asynccontextmanager
+async def cancelled_on_disconnect(request, token):
+    """
+    Cancels `token` if the client disconnects while the block runs. For the work
+    done before a response starts, streamed responses notice through `cancelling`.
+    """
+    async def watch():
+        # The body has been read, so the next message is the disconnect
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        if token.cancel():
+            record("runs_cancelled")
+
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+
+
+async def stream_plan(request):
+    """
+    Streams partial plans for a question as newline-delimited JSON. The model is
+    chosen per question (see routing.py) and the response starts once one has
+    streamed its first partial, so the X-Plan-Model header can name it. X-Plan-Route
+    holds the whole routing decision as JSON.
+    """
+    state = get_dataset(request)
+    if state is None:
+        return not_found(request)
+    body = await parse_body(request, PlanRequest)
+    if isinstance(body, Response):
+        return body
+    token = CancelToken(body.question)
+    dataset = state["dataset"]
+    route = router.choose(body.question, dataset.model, dataset.fast_model)
+    plans = router.generate(
+        route, get_async_client(), state["table_info"], token, system_message=state["system_message"]
+    )
+    try:
+        # A client that leaves before the first partial stops both models' streams
+        async with cancelled_on_disconnect(request, token):
+            first = await anext(plans)
+    except Exception as e:
+        await plans.aclose()
+        return JSONResponse({"error": f"No plan generated: {e}", "route": route.to_dict()}, status_code=503)
+    print(f"Plan for {body.question!r} from {route.model} ({route.reason}) "
+          f"after {route.first_partial_seconds} seconds{', hedged' if route.hedged else ''}"
+          f"{', fallen back' if route.fallback else ''}")
+
+    async def lines():
+        async with aclosing(plans):
+            yield ndjson(first.model_dump(mode="json"))
+            async for obj in plans:
+                yield ndjson(obj.model_dump(mode="json"))
+
+    headers = {"X-Plan-Model": route.model, "X-Plan-Route": json.dumps(route.to_dict())}
+    return StreamingResponse(cancelling(token, lines()), media_type="application/x-ndjson", headers=headers)
+
+
+def figure_line(task_index, figure):
+    # The figure is already serialized, so splice it in instead of re-encoding it
+    return f'{{"index": {task_index}, "figure": {figure or "null"}}}\n'
+
+
+async def run_plan(request):
+    """
+    Executes a plan and streams one figure per task as newline-delimited JSON.
+    Tasks with a chart type the dataset does not allow are dropped, so the
+    indexes refer to the plan as returned by prepare.
+    """
+    state = get_dataset(request)
+    if state is None:
+        return not_found(request)
+    body = await parse_body(request, VisualizationPlan)
+    if isinstance(body, Response):
+        return body
+    dataset = state["dataset"]
+    visualization_plan = body.prepare(dataset.chart_types, dataset.task_overrides, dataset.default_fields)
+    token = CancelToken(None)
+
+    async def lines():
+        figures = visualization_plan.run(state["pool"], state["table_columns"], token)
+        async for task_index, figure in iterate_in_threadpool(figures):
+            yield figure_line(task_index, figure)
+
+    return StreamingResponse(cancelling(token, lines()), media_type="application/x-ndjson")
+
+
+async def run_task(request):
+    """Executes a single task and returns its figure JSON."""
+    state = get_dataset(request)
+    if state is None:
+        return not_found(request)
+    body = await parse_body(request, VisualizationTask)
+    if isinstance(body, Response):
+        return body
+    dataset = state["dataset"]
+    prepared = VisualizationPlan(plan=[body]).prepare(
+        dataset.chart_types, dataset.task_overrides, dataset.default_fields
+    ).plan
+    if not prepared:
+        return JSONResponse({"error": f"{body.type.value} is not available for {dataset.name}"}, status_code=422)
+    token = CancelToken(None)
+    async with cancelled_on_disconnect(request, token):
+        figure = await run_in_threadpool(prepared[0].run, state["pool"], token)
+    return Response(figure_line(0, figure), media_type="application/json")
+
+
+async def list_datasets(request):
+    return JSONResponse({
+        name: {
+            "title": state["dataset"].title,
+            "example_questions": state["dataset"].example_questions,
+            "chart_types": [chart_type.value for chart_type in state["dataset"].chart_types],
+            "model": state["dataset"].model,
+            "fast_model": state["dataset"].fast_model,
+        }
+        for name, state in datasets.items()
+    })
+
+
+async def metrics(request):
+    return JSONResponse({**get_metrics(), "models": router.summary()})
+
+
+async def health(request):
+    return JSONResponse({"status": "ok"})
+
+
+app = Starlette(
+    routes=[
+        Route("/datasets", list_datasets),
+        Route("/metrics", metrics),
+        Route("/health", health),
+        Route("/{dataset}/plan", stream_plan, methods=["POST"]),
+        Route("/{dataset}/plan/run", run_plan, methods=["POST"]),
+        Route("/{dataset}/task/run", run_task, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
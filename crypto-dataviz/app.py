@@ -1,154 +1,117 @@
-from db import get_db_connection, get_table_info
-import asyncio
+import json
+import queue
+import threading
 from timeit import default_timer as timer
+import httpx
 import streamlit as st
-from pydantic import BaseModel, Field
-from enum import Enum
-from typing import List
-from openai import AsyncOpenAI
 from decouple import config
-from string import Template
-import instructor
-from visualization import get_bar_chart, get_pie_chart, get_line_chart  # Import visualization functions
+from cancellation import get_metrics, record, token_for
+from visualization import decode_typed_arrays
 
-async_client = instructor.from_openai(AsyncOpenAI(api_key=config("OPENAI_API_KEY")))
+# Plan generation and execution live in the API service (api.py); this app only
+# streams results from it and renders them.
+API_URL = config("API_URL", default="http://localhost:8000")
+# The dataset selected when the app opens, see datasets.py for the others
+DATASET = config("DATASET", default="crypto")
+# Seconds between checks for a newer run while waiting on the API
+POLL_INTERVAL = 0.1
 
 st.set_page_config(layout="wide")
 
 
 @st.cache_resource
-def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    return cursor, conn
-
-
-cur, conn = init_db()
-
-analysis_system_message = """
-You are a DuckDB and data visualization expert. Given a data visualization request, you return a visualization plan consisting of visualization tasks.
-Each visualization task consists of:
-1. Syntactically correct SQL query to get the data necessary to answer the request.
-2. The correct visualization type to use (BAR_CHART, PIE_CHART, or LINE_CHART), with the required parameters. 
-3. Parameters for the task, as a dictionary:
-    - Pie chart tasks require no parameters
-    - Bar chart tasks require a 'bar_mode', either "group" or "stack"
-    - Line chart tasks require no parameters
-
-Example parameters:
-    - bar chart: {"bar_mode": "group"}
-
-You will NEVER return a visualization task with empty parameters.
-    
-For forecasting tasks, never combine multiple values or cryptos in one query. 
-
-When generating the SQL queries, follow the instructions below:
-- Remember to aggregate when possible to return only the necessary number of rows.
-- Never query for all columns from a table. You must query only the columns that are needed to answer the question. Wrap each column name in double quotes (") to denote them as delimited identifiers.
-- Pay attention to use only the column names you can see in the table given below. Be careful to not query for columns that do not exist. Also, pay attention to which column is in which table.
-- If the question involves "today", remember to use the CURRENT_DATE function.
-- Always include the "symbol" column in the query.
-- Always use the alias "value" for the numerical value in the query, whether it's a price or volume.
-- Always use the alias "date" for the date column in the query.
-- Write the SQL query without formatting it in a code block.
-
-Think step by step before writing the query plan.
-"""
-
-request_prompt_template = Template(
-"""
-Request: $input
-
-Use the following tables:
-$table_info
-
-"""
-)
-
-async def async_generate_visualization_plan(table_info, question):
+def init_client():
+    return httpx.Client(base_url=API_URL, timeout=None)
+
+
+client = init_client()
+
+
+@st.cache_data
+def get_datasets():
+    return client.get("/datasets").json()
+
+
+def stream_lines(path, payload, token, headers=None):
+    """
+    Yields the decoded NDJSON lines of a streaming API response until the token
+    is cancelled. The response headers are copied into `headers` if given.
+    """
+    with client.stream("POST", path, json=payload) as response:
+        # Closing the response disconnects from the API, which cancels the work there
+        with token.on_cancel(response.close):
+            response.raise_for_status()
+            if headers is not None:
+                headers.update(response.headers)
+            for line in response.iter_lines():
+                if token.cancelled:
+                    return
+                if line:
+                    yield json.loads(line)
+
+
+def in_background(lines):
+    """
+    Iterates `lines` in a worker thread and yields its items in the script thread.
+
+    Streamlit stops a superseded run by raising in the script thread at its next
+    UI call, and runs the new run's widget callbacks only after that. Waiting on
+    the API in the script thread would delay both until the next line arrives,
+    so the script thread waits in short polls that each touch the page instead.
+    The exception then arrives within POLL_INTERVAL, and the run's except block
+    cancels the token, which closes the response the worker is reading.
+    """
+    items = queue.Queue()
+
+    def work():
+        try:
+            for item in lines:
+                items.put(("item", item))
+            items.put(("done", None))
+        except BaseException as e:
+            items.put(("error", e))
+
+    threading.Thread(target=work, daemon=True).start()
+    heartbeat = st.empty()
+    while True:
+        try:
+            kind, value = items.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            heartbeat.empty()
+            continue
+        if kind == "done":
+            return
+        if kind == "error":
+            raise value
+        yield value
+
+
+def generate_visualization_plan(dataset, question, token):
+    """Returns the plan and the model the API chose for it."""
     placeholder = st.empty()
-    plan = await async_client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {"role": "system", "content": analysis_system_message},
-            {
-                "role": "user",
-                "content": request_prompt_template.substitute(
-                    input=question, table_info=table_info
-                ),
-            },
-        ],
-        stream=True,
-        response_model=instructor.Partial[VisualizationPlan],
-    )
     result = None
-    async for obj in plan:
+    headers = {}
+    for obj in in_background(stream_lines(f"/{dataset}/plan", {"question": question}, token, headers)):
         placeholder.empty()
-        placeholder.write(obj.model_dump())
+        placeholder.write(obj)
         result = obj
 
     placeholder.empty()
-    return result
-
+    return (None if token.cancelled else result), headers.get("x-plan-model")
 
-class VisualizationType(Enum):
-    BAR_CHART = "BAR_CHART"
-    PIE_CHART = "PIE_CHART"
-    LINE_CHART = "LINE_CHART"  # Added LINE_CHART
 
+def run_visualization_plan(dataset, visualization_plan, token):
+    num_tasks = len(visualization_plan["plan"])
+    num_rows = (num_tasks + 1) // 2
+    cells = []
+    for row in range(num_rows):
+        cells.extend(st.columns(2))
 
-class VisualizationTask(BaseModel):
-    query: str = Field(
-        ..., description="SQL query to fetch data for visualization"
-    )
-    type: VisualizationType
-    title: str = Field(..., description="Title of the visualization")
-    parameters: dict = Field(
-        ..., description="Parameters for the visualization task, as a dictionary"
-    )
-
-    def _execute_query(self):
-        try:
-            cur.execute(self.query)
-            result = cur.fetchall()
-            cols = [desc[0] for desc in cur.description]
-            data = [dict(zip(cols, row)) for row in result]
-        except Exception as e:
-            print(f"An error occurred: {e}")
-            return []
-        return data
-
-    def run(self):
-        data = self._execute_query()
-        if data:
-            if self.type == VisualizationType.BAR_CHART:
-                fig = get_bar_chart(
-                    data=data, title=self.title, barmode=self.parameters.get("bar_mode")
-                )
-                st.plotly_chart(fig)
-
-            elif self.type == VisualizationType.PIE_CHART:
-                fig = get_pie_chart(data=data, title=self.title)
-                st.plotly_chart(fig)
-            
-            elif self.type == VisualizationType.LINE_CHART:  # Handling LINE_CHART
-                fig = get_line_chart(data=data, title=self.title)
-                st.plotly_chart(fig)
-
-
-class VisualizationPlan(BaseModel):
-    plan: List[VisualizationTask]
-
-    def run(self):
-        num_tasks = len(self.plan)
-        num_rows = (num_tasks + 1) // 2
-        for row in range(num_rows):
-            st_cols = st.columns(2)
-            for col in range(2):
-                task_index = row * 2 + col
-                if task_index < num_tasks:
-                    with st_cols[col]:
-                        self.plan[task_index].run()
+    for item in in_background(stream_lines(f"/{dataset}/plan/run", visualization_plan, token)):
+        if item["figure"] is not None:
+            with cells[item["index"]]:
+                # Figures arrive with base64 typed arrays, which plotly 5 does not accept as input
+                st.plotly_chart(decode_typed_arrays(item["figure"]))
 
 
 ## Streamlit UI
@@ -156,8 +119,23 @@ class VisualizationPlan(BaseModel):
 if 'user_input' not in st.session_state:
     st.session_state.user_input = ""
 
-st.title("Crypto Data Visualizer 📊📈")
+def reset_user_input():
+    # Questions are about one dataset, so switching clears the question
+    st.session_state.user_input = ""
+
+datasets = get_datasets()
+dataset = st.sidebar.selectbox(
+    "Dataset",
+    list(datasets),
+    index=list(datasets).index(DATASET) if DATASET in datasets else 0,
+    key="dataset",
+    format_func=lambda name: datasets[name]["title"],
+    on_change=reset_user_input,
+)
+
+st.title(datasets[dataset]["title"])
 
+# Callbacks run once the previous run has stopped, which cancelled its work on the way out
 def set_user_input(question):
     st.session_state.user_input = question
 
@@ -166,8 +144,8 @@ def set_user_input_from_field():
 
 input_field = st.text_input("Enter a question", value=st.session_state.get("user_input"), key="input_field_value", on_change=set_user_input_from_field)
 
-example_questions = ["Price of BTC in the last 30D", "Daily volumes for ETH and BTC in March 2024"]
-button_cols = st.columns([0.6, 1, 1, 2, 2])
+example_questions = datasets[dataset]["example_questions"]
+button_cols = st.columns([1, 1, 1, 2, 2])
 
 for i, question in enumerate(example_questions):
     with button_cols[i]:
@@ -175,15 +153,24 @@ for i, question in enumerate(example_questions):
 
 if len(st.session_state.user_input) > 0:
     user_input = st.session_state.user_input
-    with st.spinner("Generating query plan..."):
-        start = timer()
-        visualization_plan = asyncio.run(
-            async_generate_visualization_plan(
-                get_table_info(conn), user_input
-            )
-        )
-        end = timer()
-        st.info(f"Query plan generated in {round(end - start, 2)} seconds")
-        print(visualization_plan.model_dump())
-    st.write(visualization_plan.model_dump())
-    visualization_plan.run()
+    token = token_for(st.session_state, user_input)
+    try:
+        with st.spinner("Generating query plan..."):
+            start = timer()
+            visualization_plan, model = generate_visualization_plan(dataset, user_input, token)
+            end = timer()
+        if visualization_plan is not None:
+            st.info(f"Query plan generated by {model} in {round(end - start, 2)} seconds")
+            print(visualization_plan)
+            st.write(visualization_plan)
+            run_visualization_plan(dataset, visualization_plan, token)
+    except BaseException:
+        # Streamlit unwinds a superseded run with an exception at the next UI call,
+        # at most POLL_INTERVAL away while waiting on the API; cancel whatever that
+        # run still has in flight
+        if token.cancel():
+            record("runs_cancelled")
+        raise
+
+with st.sidebar.expander("Cancelled work"):
+    st.json({"app": get_metrics(), "api": client.get("/metrics").json()})
@@ -9,6 +9,7 @@ from openai import AsyncOpenAI
 from decouple import config
 from string import Template
 import instructor
+from grid import count_rows, fetch_page, get_columns
 
 async_client = instructor.from_openai(AsyncOpenAI(api_key=config("OPENAI_API_KEY")))
 
@@ -17,12 +18,12 @@ st.set_page_config(layout="wide")
 
 @st.cache_resource
 def init_db():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    return cursor, conn
+    return get_db_connection()
 
 
-cur, conn = init_db()
+conn = init_db()
+
+PAGE_SIZE = 50
 
 analysis_system_message = """
 You are a DuckDB and data visualization expert. Given a data visualization request, you return a visualization plan consisting of visualization tasks.
@@ -104,21 +105,39 @@ class VisualizationTask(BaseModel):
         ..., description="Parameters for the visualization task, as a dictionary"
     )
 
-    def _execute_query(self):
+    def run(self, key):
+        # Only the visible page is fetched, sorting and filtering run in DuckDB
         try:
-            cur.execute(self.query)
-            result = cur.fetchall()
-            cols = [desc[0] for desc in cur.description]
-            data = [dict(zip(cols, row)) for row in result]
+            columns = get_columns(conn, self.query)
         except Exception as e:
             print(f"An error occurred: {e}")
-            return []
-        return data
+            return
 
-    def run(self):
-        data = self._execute_query()
-        if data:
-            st.dataframe(data)
+        st.subheader(self.title)
+        control_cols = st.columns([2, 1, 2, 2])
+        sort_by = control_cols[0].selectbox(
+            "Sort by", [None] + columns, format_func=lambda column: column or "-", key=f"{key}_sort_by"
+        )
+        descending = control_cols[1].checkbox("Descending", key=f"{key}_descending")
+        filter_column = control_cols[2].selectbox("Filter on", columns, key=f"{key}_filter_column")
+        filter_text = control_cols[3].text_input("Contains", key=f"{key}_filter_text")
+        filters = {filter_column: filter_text}
+
+        try:
+            total_rows = count_rows(conn, self.query, columns, filters)
+            num_pages = max(1, -(-total_rows // PAGE_SIZE))
+            # A narrower filter can leave the current page past the end
+            if st.session_state.get(f"{key}_page", 1) > num_pages:
+                st.session_state[f"{key}_page"] = num_pages
+            # No value=, the page starts at min_value and is only set through Session State above
+            page = st.number_input("Page", min_value=1, max_value=num_pages, key=f"{key}_page")
+            table = fetch_page(conn, self.query, columns, page - 1, PAGE_SIZE, sort_by, descending, filters)
+        except Exception as e:
+            print(f"An error occurred: {e}")
+            return
+
+        st.caption(f"{total_rows} rows, page {page} of {num_pages}")
+        st.dataframe(table, use_container_width=True)
 
 class VisualizationPlan(BaseModel):
     plan: List[VisualizationTask]
@@ -132,7 +151,7 @@ class VisualizationPlan(BaseModel):
                 task_index = row * 2 + col
                 if task_index < num_tasks:
                     with st_cols[col]:
-                        self.plan[task_index].run()
+                        self.plan[task_index].run(key=f"task_{task_index}")
 
 
 ## Streamlit UI
@@ -159,15 +178,19 @@ for i, question in enumerate(example_questions):
 
 if len(st.session_state.user_input) > 0:
     user_input = st.session_state.user_input
-    with st.spinner("Generating query plan..."):
-        start = timer()
-        visualization_plan = asyncio.run(
-            async_generate_visualization_plan(
-                get_table_info(conn), user_input
+    # Paging and sorting rerun the script, so keep the plan for the current question
+    if st.session_state.get("plan_question") != user_input:
+        with st.spinner("Generating query plan..."):
+            start = timer()
+            st.session_state.visualization_plan = asyncio.run(
+                async_generate_visualization_plan(
+                    get_table_info(conn), user_input
+                )
             )
-        )
-        end = timer()
-        st.info(f"Query plan generated in {round(end - start, 2)} seconds")
-        print(visualization_plan.model_dump())
+            st.session_state.plan_question = user_input
+            end = timer()
+            st.info(f"Query plan generated in {round(end - start, 2)} seconds")
+            print(st.session_state.visualization_plan.model_dump())
+    visualization_plan = st.session_state.visualization_plan
     st.write(visualization_plan.model_dump())
     visualization_plan.run()
@@ -0,0 +1,154 @@
+"""
+Answers a file of questions offline and writes the figures to disk.
+
+Usage:
+    python batch.py questions.jsonl --output-dir output --concurrency 8 --dataset employee
+
+Each input line is a JSON object with a "question" and an optional "id". For every
+question the plan, one Plotly figure JSON per task (and a PNG with --images, which
+needs kaleido installed) are written to <output-dir>/<id>/, and one line of timings
+per question is appended to <output-dir>/timings.jsonl, with the model that
+generated the plan. Plans are routed between the dataset's models as in the API
+(see routing.py) unless --model fixes one.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from timeit import default_timer as timer
+
+import instructor
+from decouple import config
+from openai import AsyncOpenAI
+import plotly.graph_objects as go
+
+from cancellation import CancelToken
+from datasets import DATASETS, close_datasets, open_datasets
+from plan import VisualizationPlan
+from routing import ModelRouter
+from visualization import decode_typed_arrays, with_template
+
+
+def read_questions(path):
+    with open(path) as f:
+        for line_number, line in enumerate(f):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            question_id = str(item.get("id", line_number))
+            yield re.sub(r"[^\w.-]", "_", question_id), item["question"]
+
+
+async def generate_plan(client, router, db, question, token, models, retries):
+    """
+    Generates a complete plan, retrying failed or incomplete generations with
+    backoff. Returns the plan, the number of attempts and the last route.
+    """
+    dataset = db["dataset"]
+    for attempt in range(retries + 1):
+        try:
+            result = None
+            route = router.choose(question, *models)
+            plans = router.generate(route, client, db["table_info"], token, system_message=db["system_message"])
+            async for obj in plans:
+                result = obj
+            # The last partial must validate as a complete plan
+            visualization_plan = VisualizationPlan.model_validate(result.model_dump())
+            prepared = visualization_plan.prepare(dataset.chart_types, dataset.task_overrides, dataset.default_fields)
+            return prepared, attempt + 1, route
+        except Exception as e:
+            if attempt == retries:
+                raise
+            print(f"Plan for {question!r} failed on attempt {attempt + 1}: {e}")
+            await asyncio.sleep(2 ** attempt)
+
+
+def write_figures(visualization_plan, db_pool, table_columns, token, question_dir, images):
+    figures = 0
+    for task_index, figure in visualization_plan.run(db_pool, table_columns, token):
+        if figure is None:
+            continue
+        with open(os.path.join(question_dir, f"task_{task_index}.json"), "w") as f:
+            f.write(with_template(figure))
+        if images:
+            fig = go.Figure(decode_typed_arrays(json.loads(figure)))
+            fig.write_image(os.path.join(question_dir, f"task_{task_index}.png"))
+        figures += 1
+    return figures
+
+
+async def answer(question_id, question, args, client, router, semaphore, pool, db):
+    timings = {"id": question_id, "question": question}
+    question_dir = os.path.join(args.output_dir, question_id)
+    os.makedirs(question_dir, exist_ok=True)
+    token = CancelToken(question)
+    try:
+        # Only plan generation is limited, that is where the LLM rate limit applies
+        async with semaphore:
+            start = timer()
+            models = (args.model,) if args.model else (db["dataset"].model, db["dataset"].fast_model)
+            visualization_plan, attempts, route = await generate_plan(
+                client, router, db, question, token, models, args.retries
+            )
+            timings["plan_seconds"] = round(timer() - start, 3)
+            timings["attempts"] = attempts
+            timings.update(route.to_dict())
+
+        with open(os.path.join(question_dir, "plan.json"), "w") as f:
+            f.write(visualization_plan.model_dump_json(indent=2))
+
+        start = timer()
+        timings["figures"] = await asyncio.get_running_loop().run_in_executor(
+            pool, write_figures, visualization_plan, db["pool"], db["table_columns"], token, question_dir, args.images
+        )
+        timings["execute_seconds"] = round(timer() - start, 3)
+    except Exception as e:
+        print(f"Question {question_id} failed: {e}")
+        timings["error"] = str(e)
+    return timings
+
+
+async def main(args):
+    client = instructor.from_openai(AsyncOpenAI(api_key=config("OPENAI_API_KEY")))
+    # One cursor per worker thread, so the pool does not limit task execution
+    opened = open_datasets([replace(DATASETS[args.dataset], pool_size=args.workers)])
+    if args.dataset not in opened:
+        return
+    db = opened[args.dataset]
+    os.makedirs(args.output_dir, exist_ok=True)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    router = ModelRouter()
+
+    start = timer()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        pending = [
+            answer(question_id, question, args, client, router, semaphore, pool, db)
+            for question_id, question in read_questions(args.input)
+        ]
+        with open(os.path.join(args.output_dir, "timings.jsonl"), "w") as f:
+            for result in asyncio.as_completed(pending):
+                timings = await result
+                f.write(json.dumps(timings) + "\n")
+                f.flush()
+    elapsed = timer() - start
+    close_datasets(opened)
+
+    print(f"Answered {len(pending)} questions in {round(elapsed, 2)} seconds "
+          f"({round(len(pending) / elapsed, 2) if elapsed else 0} questions/second)")
+    print(f"Models: {json.dumps(router.summary())}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Answer a JSONL file of questions and write the figures")
+    parser.add_argument("input", help="JSONL file with one {\"question\": ..., \"id\": ...} per line")
+    parser.add_argument("--output-dir", default="output")
+    parser.add_argument("--concurrency", type=int, default=4, help="Plans generated at the same time")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per plan generation")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Threads executing tasks")
+    parser.add_argument("--dataset", default="crypto", choices=list(DATASETS))
+    parser.add_argument("--model", help="Use only this model instead of routing between the dataset's models")
+    parser.add_argument("--images", action="store_true", help="Also write PNGs (requires kaleido)")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,88 @@
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+# Work saved by cancelling superseded runs, shared by every session in the process
+_metrics = Counter()
+_metrics_lock = threading.Lock()
+
+
+def record(name, amount=1):
+    with _metrics_lock:
+        _metrics[name] += amount
+
+
+def get_metrics():
+    with _metrics_lock:
+        return dict(_metrics)
+
+
+class CancelToken:
+    """
+    Cooperative cancellation flag for everything done on behalf of one question.
+
+    Long running work (the LLM stream, DuckDB queries) registers a callback with
+    `on_cancel` so it can be interrupted from another thread as soon as the token
+    is cancelled, and checks `cancelled` between units of work.
+    """
+
+    def __init__(self, question):
+        self.question = question
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = {}
+        self._next_id = 0
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancels the token. Returns False if it was already cancelled."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._event.set()
+            callbacks = list(self._callbacks.values())
+            self._callbacks.clear()
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Cancel callback failed: {e}")
+        return True
+
+    @contextmanager
+    def on_cancel(self, callback):
+        """Runs `callback` if the token is cancelled while the block is executing."""
+        with self._lock:
+            callback_id = self._next_id
+            self._next_id += 1
+            self._callbacks[callback_id] = callback
+        if self.cancelled:
+            callback()
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._callbacks.pop(callback_id, None)
+
+
+def cancel_superseded(session_state, question):
+    """Cancels the session's in-flight run if it was started for another question."""
+    token = session_state.get("cancel_token")
+    if token is not None and token.question != question and token.cancel():
+        record("runs_cancelled")
+
+
+def token_for(session_state, question):
+    """Returns the session's token for `question`, replacing a superseded one."""
+    token = session_state.get("cancel_token")
+    if token is not None and token.question == question and not token.cancelled:
+        return token
+
+    cancel_superseded(session_state, question)
+    token = CancelToken(question)
+    session_state["cancel_token"] = token
+    return token
@@ -0,0 +1,153 @@
+"""
+The datasets one engine process can serve.
+
+Each dataset is a DuckDB file with its own tables, prompt rules, allowed chart
+types and model. The API opens every enabled dataset once per worker, with a
+connection pool and schema description of its own, instead of running one app
+per database.
+"""
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from decouple import config
+
+from db import ConnectionPool, get_table_columns, get_table_info, warm_up
+import indicators
+from plan import CRYPTO_CHART_TYPES, CRYPTO_DEFAULT_FIELDS, CRYPTO_QUERY_RULES, VisualizationType, build_system_message
+
+EMPLOYEE_QUERY_RULES = """
+When generating the SQL queries, follow the instructions below:
+- Remember to aggregate when possible to return only the necessary number of rows.
+- Never query for all columns from a table. You must query only the columns that are needed to answer the question. Wrap each column name in double quotes (") to denote them as delimited identifiers.
+- Pay attention to use only the column names you can see in the table given below. Be careful to not query for columns that do not exist. Also, pay attention to which column is in which table.
+- If the question involves "today", remember to use the CURRENT_DATE function.
+- Always include the "department" column in the query if relevant.
+- Always use the alias "value" for the numerical value in the query if appropriate.
+- Always use the alias "date" for the date column in the query if appropriate.
+- Write the SQL query without formatting it in a code block.
+"""
+
+# As employee-dataviz draws them: bars per department without groups, lines of interactions over time
+EMPLOYEE_DEFAULT_FIELDS = {
+    "BAR_CHART": {"x_field": "department", "y_field": "value", "group_field": None},
+    "PIE_CHART": {"x_field": "department", "y_field": "value"},
+    "LINE_CHART": {"x_field": "interaction_date", "y_field": "interaction_count", "group_field": "department"},
+}
+
+
+@dataclass
+class Dataset:
+    name: str
+    title: str
+    db_path: str
+    tables: List[str]
+    chart_types: List[VisualizationType]
+    query_rules: str
+    example_questions: List[str]
+    model: str = "gpt-4o"
+    # Takes simple questions and hedges the model when it is slow, see routing.py
+    fast_model: Optional[str] = "gpt-4o-mini"
+    # Let the model choose x, y and group fields instead of the fixed aliases
+    fields: bool = False
+    pool_size: int = 4
+    # Per chart type: fields that replace the model's and parameters used when it gives none
+    task_overrides: Dict[str, dict] = field(default_factory=dict)
+    # Per chart type: fields a task draws when the model gives none, see plan.CRYPTO_DEFAULT_FIELDS
+    default_fields: Dict[str, dict] = field(default_factory=lambda: CRYPTO_DEFAULT_FIELDS)
+    # Called with the connection and each pooled cursor, e.g. to register macros
+    setup: Optional[Callable] = None
+    # Table macros described in the prompt, as {name: (signature, description)}
+    macros: Dict[str, tuple] = field(default_factory=dict)
+
+    @property
+    def system_message(self):
+        return build_system_message(self.chart_types, self.query_rules, fields=self.fields)
+
+
+DATASETS = {
+    "crypto": Dataset(
+        name="crypto",
+        title="Crypto Data Visualizer 📊📈",
+        db_path=config("CRYPTO_DB_PATH", default="data/crypto_data.duckdb"),
+        tables=["crypto_data", "crypto_indicators"],
+        chart_types=CRYPTO_CHART_TYPES,
+        query_rules=CRYPTO_QUERY_RULES,
+        example_questions=[
+            "Price of BTC in the last 30D",
+            "Daily volumes for ETH and BTC in March 2024",
+            "30-day volatility of ETH and SOL",
+        ],
+        setup=indicators.register_macros,
+        macros=indicators.describe_macros(),
+    ),
+    "employee": Dataset(
+        name="employee",
+        title="Text to Network Graph Visualizer 🌐📈",
+        db_path=config("EMPLOYEE_DB_PATH", default="../employee-dataviz/data/graph_data.duckdb"),
+        tables=["employee_interactions"],
+        chart_types=[
+            VisualizationType.BAR_CHART,
+            VisualizationType.PIE_CHART,
+            VisualizationType.LINE_CHART,
+            VisualizationType.NETWORK_GRAPH,
+        ],
+        query_rules=EMPLOYEE_QUERY_RULES,
+        example_questions=[
+            "Connections between departments",
+            "Interactions between employees",
+            "Employee interactions by department",
+            "Interactions by employee",
+        ],
+        model="gpt-3.5-turbo",
+        # gpt-3.5-turbo is weaker than the default fast model, so it plans alone, without routing
+        fast_model=None,
+        fields=True,
+        default_fields=EMPLOYEE_DEFAULT_FIELDS,
+        task_overrides={
+            "PIE_CHART": {"x_field": "department", "y_field": "value"},
+            "NETWORK_GRAPH": {
+                "x_field": "source",
+                "y_field": "target",
+                "parameters": {"source_field": "source", "target_field": "target", "edge_field": "value", "graph_type": "undirected"},
+            },
+        },
+    ),
+}
+
+
+def enabled_datasets():
+    """The datasets named in DATASETS (comma separated), all of them by default."""
+    names = config("DATASETS", default=",".join(DATASETS), cast=lambda value: [name.strip() for name in value.split(",") if name.strip()])
+    return [DATASETS[name] for name in names]
+
+
+def open_datasets(datasets, warm=False):
+    """
+    Opens a connection pool per dataset and describes its tables once. Datasets
+    whose database file is missing are skipped, so a deployment only needs the
+    files it serves.
+    """
+    opened = {}
+    for dataset in datasets:
+        if not os.path.exists(dataset.db_path):
+            print(f"Skipping dataset {dataset.name}: {dataset.db_path} not found")
+            continue
+        pool = ConnectionPool(dataset.db_path, size=dataset.pool_size, setup=dataset.setup)
+        table_columns = {table_name: get_table_columns(pool.conn, table_name) for table_name in dataset.tables}
+        if warm:
+            warm_up(pool.conn, table_columns)
+        opened[dataset.name] = {
+            "dataset": dataset,
+            "pool": pool,
+            "table_info": get_table_info(pool.conn, dataset.tables, dataset.macros),
+            "table_columns": table_columns,
+            "system_message": dataset.system_message,
+        }
+    return opened
+
+
+def close_datasets(opened):
+    for state in opened.values():
+        state["pool"].close()
+    opened.clear()
@@ -1,11 +1,13 @@
+import queue
+from contextlib import contextmanager
 import duckdb
 
 def get_db_connection(db_path='data/crypto_data.duckdb'):
     return duckdb.connect(db_path, read_only = True)
 
-def get_table_info(conn):
-    table_info = "### Table: crypto_data\n"
-    
+def get_table_info(conn, table_names=('crypto_data',), macros=None):
+    table_info = ""
+
     query = """
         SELECT 
             column_name,
@@ -13,16 +15,74 @@ def get_table_info(conn):
             COALESCE(comment, 'No description') as col_description
         FROM 
             duckdb_columns
-        WHERE table_name = 'crypto_data'
+        WHERE table_name = ?
     """
-    
-    result = conn.sql(query).fetchall()
-    for row in result:
-        column_name, data_type, col_description = row
-        table_info += f"col_name: {column_name}, dtype: {data_type}, description: {col_description}\n"
+
+    for table_name in table_names:
+        table_info += f"### Table: {table_name}\n"
+        result = conn.execute(query, [table_name]).fetchall()
+        for row in result:
+            column_name, data_type, col_description = row
+            table_info += f"col_name: {column_name}, dtype: {data_type}, description: {col_description}\n"
+
+    # Table macros the queries can select from, as {name: (signature, description)}
+    if macros:
+        table_info += "### Table macros\n"
+        for signature, description in macros.values():
+            table_info += f"macro: {signature}, returns: symbol, date, value, description: {description}\n"
     
     return table_info
 
+def get_table_columns(conn, table_name='crypto_data'):
+    query = """
+        SELECT column_name
+        FROM duckdb_columns
+        WHERE table_name = ?
+        ORDER BY column_index
+    """
+    return [row[0] for row in conn.execute(query, [table_name]).fetchall()]
+
+def warm_up(conn, table_columns):
+    """Reads every column of the given tables once so the first queries run against a warm cache."""
+    for table_name, columns in table_columns.items():
+        aggregates = ", ".join(f'max("{column}")' for column in columns)
+        conn.execute(f'SELECT count(*), {aggregates} FROM "{table_name}"').fetchall()
+
+class ConnectionPool:
+    """
+    A read-only connection to one DuckDB file and a fixed set of cursors over it.
+
+    Cursors are handed out to one thread at a time, which also bounds how many
+    queries run against the database at once. `setup` is called with the
+    connection and every cursor, e.g. to register macros, which DuckDB keeps
+    per cursor.
+    """
+
+    def __init__(self, db_path, size=4, setup=None):
+        self.db_path = db_path
+        self.conn = get_db_connection(db_path)
+        self._cursors = queue.LifoQueue()
+        if setup:
+            setup(self.conn)
+        for _ in range(size):
+            cursor = self.conn.cursor()
+            if setup:
+                setup(cursor)
+            self._cursors.put(cursor)
+
+    @contextmanager
+    def cursor(self):
+        cursor = self._cursors.get()
+        try:
+            yield cursor
+        finally:
+            self._cursors.put(cursor)
+
+    def close(self):
+        while not self._cursors.empty():
+            self._cursors.get_nowait().close()
+        self.conn.close()
+
 # Example usage:
 if __name__ == "__main__":
     conn = get_db_connection()
@@ -0,0 +1,193 @@
+"""
+Forecasts every series of a chart at once.
+
+The series are stacked into one matrix, right aligned so they all end in the last
+column and padded with NaN at the start, and the models run over the whole matrix
+with NumPy: exponential smoothing steps through time once for all series and all
+candidate smoothing parameters together, and the linear trend is a closed form
+least squares fit per row.
+"""
+import warnings
+from statistics import NormalDist
+
+import numpy as np
+
+METHODS = ("holt_winters", "linear")
+
+# Smoothing parameters tried for every series, the best one-step-ahead fit wins
+ALPHAS = (0.1, 0.3, 0.5, 0.7, 0.9)
+BETAS = (0.01, 0.05, 0.1, 0.2)
+GAMMAS = (0.05, 0.2)
+
+
+def _axis(values):
+    # Dates are forecast as epoch milliseconds and converted back at the end
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+    return values.astype(np.float64)
+
+
+def to_matrix(series):
+    """
+    Stacks (x, y) series into x and y matrices of shape (number of series, longest
+    series). Each series is sorted by x and right aligned, earlier cells are NaN.
+    """
+    length = max((len(values["y"]) for values in series.values()), default=0)
+    x = np.full((len(series), length), np.nan)
+    y = np.full((len(series), length), np.nan)
+    for row, values in enumerate(series.values()):
+        x_values = _axis(values["x"])
+        order = np.argsort(x_values, kind="stable")
+        count = len(order)
+        if count:
+            x[row, -count:] = x_values[order]
+            y[row, -count:] = values["y"].astype(np.float64)[order]
+    return x, y
+
+
+def _future_x(x, horizon):
+    # Each series continues with its own median step, e.g. one day for daily data
+    with warnings.catch_warnings():
+        # Series whose points all share one x have no step
+        warnings.simplefilter("ignore", RuntimeWarning)
+        steps = np.nanmedian(np.diff(x, axis=1), axis=1)
+    usable = np.isfinite(steps) & (steps != 0)
+    # Those take the median step of the others, a step of 1 would be a millisecond on a date axis
+    fallback = np.median(steps[usable]) if usable.any() else 1.0
+    steps = np.where(usable, steps, fallback)
+    return x[:, -1:] + steps[:, None] * np.arange(1, horizon + 1)
+
+
+def holt_winters(y, horizon, season_length=None):
+    """
+    Additive Holt-Winters, or Holt's linear trend without `season_length`.
+
+    Every series is fitted with every combination of smoothing parameters in one
+    pass over time, and keeps the combination with the smallest one-step-ahead
+    squared error. Returns the forecasts and the standard deviation of each
+    forecast step, both of shape (number of series, horizon).
+    """
+    seasonal = bool(season_length and season_length > 1 and y.shape[1] >= 2 * season_length)
+    m = season_length if seasonal else 1
+    grid = np.array([
+        (alpha, beta, gamma)
+        for alpha in ALPHAS for beta in BETAS for gamma in (GAMMAS if seasonal else (0.0,))
+    ])
+    num_series, length = y.shape
+    # One row per (series, parameters) pair, stored time major for the loop below
+    values = np.ascontiguousarray(np.repeat(y, len(grid), axis=0).T)
+    alpha, beta, gamma = (np.tile(grid[:, i], num_series) for i in range(3))
+
+    level = np.full(len(alpha), np.nan)
+    trend = np.zeros(len(alpha))
+    # One row per season position, so each step reads and writes contiguous memory
+    season = np.zeros((m, len(alpha)))
+    sse = np.zeros(len(alpha))
+    count = np.zeros(len(alpha))
+    for t in range(length):
+        y_t = values[t]
+        s = season[t % m]
+        observed = ~np.isnan(y_t)
+        started = ~np.isnan(level)
+
+        # Series start with their first observation as level and no trend
+        first = observed & ~started
+        level[first] = y_t[first]
+
+        update = observed & started
+        error = np.where(update, y_t - (level + trend + s), 0.0)
+        sse += error ** 2
+        count += update
+
+        new_level = np.where(update, alpha * (y_t - s) + (1 - alpha) * (level + trend), level + trend)
+        new_level = np.where(started, new_level, level)
+        trend = np.where(update, beta * (new_level - level) + (1 - beta) * trend, trend)
+        if seasonal:
+            season[t % m] = np.where(update, gamma * (y_t - new_level) + (1 - gamma) * s, s)
+        level = new_level
+
+    mse = np.where(count > 0, sse / np.maximum(count, 1), np.inf).reshape(num_series, len(grid))
+    best = np.argmin(mse, axis=1)
+    rows = np.arange(num_series) * len(grid) + best
+
+    steps = np.arange(1, horizon + 1)
+    season_index = (length - 1 + steps) % m
+    mean = level[rows, None] + steps * trend[rows, None] + season[season_index][:, rows].T
+
+    # Forecast variance grows with the horizon as the errors feed into level, trend and season
+    a, b, g = (p[rows, None] for p in (alpha, beta, gamma))
+    j = steps[:-1][None, :]
+    weights = (a * (1 + j * b) + g * (j % m == 0)) ** 2
+    variance = np.concatenate([np.zeros((num_series, 1)), np.cumsum(weights, axis=1)], axis=1) + 1
+    sigma = np.sqrt(mse[np.arange(num_series), best])
+    sigma = np.where(np.isfinite(sigma), sigma, np.nan)
+    return mean, sigma[:, None] * np.sqrt(variance)
+
+
+def linear_trend(x, y, horizon):
+    """
+    Least squares line per series, ignoring NaN cells. Returns the forecasts at
+    the future x values and the standard deviation of a new observation there.
+    """
+    observed = ~np.isnan(y)
+    n = observed.sum(axis=1)
+    x_obs = np.where(observed, x, 0.0)
+    y_obs = np.where(observed, y, 0.0)
+    x_mean = x_obs.sum(axis=1) / np.maximum(n, 1)
+    y_mean = y_obs.sum(axis=1) / np.maximum(n, 1)
+    dx = np.where(observed, x - x_mean[:, None], 0.0)
+    dy = np.where(observed, y - y_mean[:, None], 0.0)
+    sxx = (dx ** 2).sum(axis=1)
+    slope = np.where(sxx > 0, (dx * dy).sum(axis=1) / np.where(sxx > 0, sxx, 1), 0.0)
+    intercept = y_mean - slope * x_mean
+
+    residuals = np.where(observed, y - (intercept[:, None] + slope[:, None] * x), 0.0)
+    sigma = np.sqrt((residuals ** 2).sum(axis=1) / np.maximum(n - 2, 1))
+
+    future = _future_x(x, horizon)
+    mean = intercept[:, None] + slope[:, None] * future
+    leverage = 1 + 1 / np.maximum(n, 1)[:, None] + (future - x_mean[:, None]) ** 2 / np.where(sxx > 0, sxx, np.inf)[:, None]
+    return mean, sigma[:, None] * np.sqrt(leverage)
+
+
+def forecast_series(series, horizon=30, method="holt_winters", season_length=None, level=0.95):
+    """
+    Forecasts `horizon` steps past the end of every series.
+
+    Parameters:
+    - series: Dictionary of {"x": ..., "y": ...} arrays per series, as returned by extract_chart_data.
+    - method: "holt_winters" or "linear".
+    - season_length: Steps per season for Holt-Winters, e.g. 7 for a weekly pattern in daily data.
+    - level: Coverage of the prediction interval.
+
+    Returns a dictionary with {"x", "mean", "lower", "upper"} arrays per series
+    with at least two points.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown forecast method {method!r}, expected one of {METHODS}")
+    horizon = int(horizon)
+    # A series needs two points for a step and a trend, shorter ones get no forecast
+    series = {name: values for name, values in series.items() if len(values["y"]) >= 2}
+    if not series or horizon < 1:
+        return {}
+
+    x, y = to_matrix(series)
+    if method == "linear":
+        mean, spread = linear_trend(x, y, horizon)
+    else:
+        mean, spread = holt_winters(y, horizon, season_length)
+
+    z = NormalDist().inv_cdf(0.5 + level / 2)
+    future = _future_x(x, horizon)
+    forecasts = {}
+    for row, (name, values) in enumerate(series.items()):
+        future_x = future[row]
+        if values["x"].dtype.kind == "M":
+            future_x = future_x.round().astype(np.int64).astype("datetime64[ms]")
+        forecasts[name] = {
+            "x": future_x,
+            "mean": mean[row],
+            "lower": mean[row] - z * spread[row],
+            "upper": mean[row] + z * spread[row],
+        }
+    return forecasts
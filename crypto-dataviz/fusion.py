@@ -0,0 +1,211 @@
+import json
+import re
+
+
+def _table_pattern(table_name):
+    # Matches `FROM crypto_data`, `JOIN "crypto_data"`, `FROM main.crypto_data`, ...
+    return re.compile(
+        rf'\b(FROM|JOIN)(\s+)((?:"?main"?\.)?"?{re.escape(table_name)}"?)(?=[\s,;)]|$)',
+        re.IGNORECASE,
+    )
+
+
+def _clean(query):
+    return query.strip().rstrip(";").strip()
+
+
+def group_tasks_by_table(queries, table_names):
+    """
+    Groups query indexes by the base table they scan.
+
+    Only queries that read from exactly one of `table_names` are candidates for
+    fusion; everything else is left to run on its own.
+    """
+    groups = {}
+    for index, query in enumerate(queries):
+        tables = [name for name in table_names if _table_pattern(name).search(query)]
+        if len(tables) == 1:
+            groups.setdefault(tables[0], []).append(index)
+    return groups
+
+
+def referenced_columns(queries, columns):
+    """Returns the subset of `columns` the queries can possibly use."""
+    select_star = re.compile(r"SELECT\s+(DISTINCT\s+)?\*|\w\.\*", re.IGNORECASE)
+    if any(select_star.search(query) for query in queries):
+        return list(columns)
+
+    text = "\n".join(queries)
+    return [
+        column for column in columns
+        if re.search(rf'(?<![\w"]){re.escape(column)}(?![\w"])|"{re.escape(column)}"', text, re.IGNORECASE)
+    ]
+
+
+def _parse(cursor, query):
+    # DuckDB's own parser, as a JSON tree of the statement
+    tree = json.loads(cursor.execute("SELECT json_serialize_sql(CAST(? AS VARCHAR))", [query]).fetchone()[0])
+    if tree.get("error") or len(tree["statements"]) != 1:
+        return None
+    return tree["statements"][0]["node"]
+
+
+def _nodes(tree):
+    if isinstance(tree, dict):
+        yield tree
+        tree = list(tree.values())
+    if isinstance(tree, list):
+        for child in tree:
+            yield from _nodes(child)
+
+
+def task_filter(cursor, query, table_name, columns):
+    """
+    Returns the parse tree of the WHERE clause of `query` if the query can read
+    from rows of `table_name` filtered by it, or None.
+
+    That is a plain SELECT from the table alone, no joins, subqueries or CTEs,
+    whose filter only uses the table's columns. Such a query gives the same result
+    on any subset of the table that contains the rows its filter keeps.
+    """
+    if len(_table_pattern(table_name).findall(query)) != 1:
+        return None
+    node = _parse(cursor, _clean(query))
+    if node is None or node["type"] != "SELECT_NODE" or node["cte_map"]["map"] or node["where_clause"] is None:
+        return None
+    table = node["from_table"]
+    if table["type"] != "BASE_TABLE" or table["table_name"].lower() != table_name.lower():
+        return None
+    if table["schema_name"] not in ("", "main") or table["catalog_name"]:
+        return None
+
+    where = node["where_clause"]
+    names = {column.lower() for column in columns}
+    qualifiers = {table_name.lower(), table["alias"].lower()} - {""}
+    for expression in _nodes(where):
+        if "query_location" in expression:
+            # So that the same condition in two queries compares equal
+            expression["query_location"] = 0
+        if expression.get("class") == "SUBQUERY":
+            return None
+        if expression.get("class") == "COLUMN_REF":
+            *qualifier, column = expression["column_names"]
+            if column.lower() not in names or (qualifier and qualifier[-1].lower() not in qualifiers):
+                return None
+            # The shared CTE has no alias, and the table's name is its own
+            expression["column_names"] = [column]
+    return where
+
+
+def _conjuncts(where):
+    if where["class"] == "CONJUNCTION" and where["type"] == "CONJUNCTION_AND":
+        return [conjunct for child in where["children"] for conjunct in _conjuncts(child)]
+    return [where]
+
+
+def _conjunction(kind, expressions):
+    if len(expressions) == 1:
+        return expressions[0]
+    return {"class": "CONJUNCTION", "type": f"CONJUNCTION_{kind}", "alias": "", "query_location": 0,
+            "children": expressions}
+
+
+def shared_filters(filters):
+    """
+    Groups {position: WHERE clause} by the conditions they share, and returns a
+    list of (positions, WHERE clause of the group). The group's clause keeps the
+    shared conditions and any of the positions' other ones, so it keeps every row
+    their own clauses keep. Clauses that share no condition with another are left
+    out.
+    """
+    conjuncts = {
+        position: {json.dumps(conjunct, sort_keys=True): conjunct for conjunct in _conjuncts(where)}
+        for position, where in filters.items()
+    }
+    groups = []
+    while True:
+        sharing = {}
+        for position, conditions in conjuncts.items():
+            for key in conditions:
+                sharing.setdefault(key, []).append(position)
+        positions = max(sharing.values(), key=len, default=[])
+        if len(positions) < 2:
+            return groups
+        keyed = [conjuncts.pop(position) for position in positions]
+        shared = set.intersection(*(set(conditions) for conditions in keyed))
+        where = [conjunct for key, conjunct in keyed[0].items() if key in shared]
+        others = [[conjunct for key, conjunct in conditions.items() if key not in shared] for conditions in keyed]
+        # A position with nothing but the shared conditions keeps every row the group reads
+        if all(others):
+            where.append(_conjunction("OR", [_conjunction("AND", other) for other in others]))
+        groups.append((positions, _conjunction("AND", where)))
+
+
+def build_base_query(cursor, table_name, columns, where):
+    """Returns the SELECT of `columns` from `table_name` with the WHERE clause parse tree `where`."""
+    projection = ", ".join(f'"{column}"' for column in columns)
+    tree = json.loads(cursor.execute(
+        "SELECT json_serialize_sql(CAST(? AS VARCHAR))", [f'SELECT {projection} FROM main."{table_name}" WHERE TRUE']
+    ).fetchone()[0])
+    tree["statements"][0]["node"]["where_clause"] = where
+    return cursor.execute("SELECT json_deserialize_sql(CAST(? AS VARCHAR))", [json.dumps(tree)]).fetchone()[0]
+
+
+def build_fused_query(queries, table_name, base_query):
+    """
+    Builds one statement that scans `table_name` once for all `queries`.
+
+    The rows of `base_query` are read into a materialized CTE named after the
+    table, which the task queries then read from instead of the table. Each task's
+    rows come back as a list of structs in its own column, so tasks with different
+    result shapes can share the statement and the row order of each task is kept.
+    """
+    pattern = _table_pattern(table_name)
+    ctes = [f'"{table_name}" AS MATERIALIZED ({base_query})']
+    for index, query in enumerate(queries):
+        # `main.crypto_data` would still read the table itself
+        rewritten = pattern.sub(lambda match: f'{match[1]}{match[2]}"{table_name}"', _clean(query))
+        # On lines of its own, so a comment at the end of the query does not swallow the parenthesis
+        ctes.append(f"__task_{index} AS (\n{rewritten}\n)")
+
+    outputs = ", ".join(
+        f"(SELECT list(__task_{index}) FROM __task_{index}) AS __task_{index}" for index in range(len(queries))
+    )
+    return "WITH " + ",\n".join(ctes) + f"\nSELECT {outputs}"
+
+
+def run_fused(cursor, queries, table_name, columns, max_rows):
+    """
+    Runs the queries that share a condition on `table_name` as fused queries, and
+    returns {position in `queries`: {column name: NumPy array}} for them.
+
+    Queries are fused when they share a condition. The shared conditions go into
+    the CTE's WHERE clause, where DuckDB pushes them into the scan to skip row
+    groups as it would for each query alone, along with the other conditions of
+    every query combined with OR. Queries with no condition in common would make
+    the CTE an unpruned scan, or without any filter a copy of the table, so they
+    run on their own. So do the queries of a group whose CTE would hold more than
+    `max_rows` rows, which stream their results instead.
+    """
+    filters = {}
+    for position, query in enumerate(queries):
+        where = task_filter(cursor, query, table_name, columns)
+        if where is not None:
+            filters[position] = where
+
+    results = {}
+    for positions, where in shared_filters(filters):
+        fused = [queries[position] for position in positions]
+        base_query = build_base_query(cursor, table_name, referenced_columns(fused, columns) or list(columns), where)
+        # Reads only the filter columns of the row groups the scan does not skip
+        count = cursor.execute(f"SELECT count(*) FROM (SELECT 1 FROM ({base_query}) LIMIT {int(max_rows) + 1})")
+        if count.fetchone()[0] > max_rows:
+            continue
+        table = cursor.execute(build_fused_query(fused, table_name, base_query)).arrow()
+        for position, column in zip(positions, table.columns):
+            # The one row holds a list of structs, which Arrow turns into columns without Python objects
+            rows = column.combine_chunks().flatten()
+            results[position] = {
+                field.name: rows.field(index).to_numpy(zero_copy_only=False) for index, field in enumerate(rows.type)
+            }
+    return results
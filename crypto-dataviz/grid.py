@@ -0,0 +1,69 @@
+import pyarrow as pa
+
+
+def _clean(query):
+    return query.strip().rstrip(";").strip()
+
+
+def _subquery(query):
+    # On lines of its own, so a comment at the end of the query does not swallow the parenthesis
+    return f"(\n{_clean(query)}\n)"
+
+
+def _quote(column):
+    return '"' + column.replace('"', '""') + '"'
+
+
+def get_columns(conn, query):
+    """Returns the result column names of `query` without running it."""
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"SELECT * FROM {_subquery(query)} LIMIT 0")
+        return [desc[0] for desc in cursor.description]
+    finally:
+        cursor.close()
+
+
+def _where(columns, filters):
+    """
+    Builds a WHERE clause matching rows whose columns contain the filter text.
+    Only known result columns are accepted, the values are passed as parameters.
+    """
+    clauses, params = [], []
+    for column, text in (filters or {}).items():
+        if column in columns and text:
+            clauses.append(f"CAST({_quote(column)} AS VARCHAR) ILIKE ?")
+            params.append(f"%{text}%")
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def count_rows(conn, query, columns, filters=None):
+    where, params = _where(columns, filters)
+    cursor = conn.cursor()
+    try:
+        return cursor.execute(f"SELECT count(*) FROM {_subquery(query)}{where}", params).fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def fetch_page(conn, query, columns, page, page_size, sort_by=None, descending=False, filters=None):
+    """
+    Fetches one page of the query result as an Arrow table.
+
+    Sorting, filtering and paging are pushed into the SQL, and the rows are read
+    through a record batch reader, so only the requested window is ever
+    materialized in Python regardless of the size of the full result.
+    """
+    where, params = _where(columns, filters)
+    order = ""
+    if sort_by in columns:
+        order = f" ORDER BY {_quote(sort_by)} {'DESC' if descending else 'ASC'} NULLS LAST"
+
+    sql = f"SELECT * FROM {_subquery(query)}{where}{order} LIMIT {int(page_size)} OFFSET {int(page) * int(page_size)}"
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql, params)
+        reader = cursor.fetch_record_batch(rows_per_batch=page_size)
+        return pa.Table.from_batches(list(reader), schema=reader.schema)
+    finally:
+        cursor.close()
@@ -0,0 +1,175 @@
+"""
+Technical indicators over the closing prices in crypto_data.
+
+Every indicator is available two ways:
+- as a table macro taking the window length, e.g. `SELECT * FROM sma(50, sym := 'BTC')`,
+  registered on each connection by register_macros
+- as a column of crypto_indicators for the common windows in MATERIALIZED, written
+  by scripts/load_data.py, so charts of those are plain lookups
+
+Both are generated from the same SQL below, except that the materialized EMAs are
+computed with NumPy, since the SQL form weighs a list of past prices per row. The
+window functions run in one pass per symbol, and the optional `sym` argument
+filters before the windows, so the sorted table only reads that symbol's rows.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+import pyarrow as pa
+
+WINDOW = 'PARTITION BY "symbol" ORDER BY "date"'
+# The last n rows. Averages over it are NULL until it holds n values, as with pandas'
+# rolling(n), like returns are until there is a price n rows back
+LAST_N = f'{WINDOW} ROWS BETWEEN {{n}} - 1 PRECEDING AND CURRENT ROW'
+
+# Closing prices with the return since the previous row, which the other indicators build on
+BASE_QUERY = f"""
+    SELECT "symbol", "date", "close", "close" / lag("close") OVER ({WINDOW}) - 1 AS "daily_return"
+    FROM crypto_data{{where}}
+"""
+
+
+@dataclass
+class Indicator:
+    description: str
+    # Window expression over BASE_QUERY, with {n} for the window length
+    window: str
+    # Expression over the window result {column}, when it needs a second step
+    final: Optional[str] = None
+    # Whether the indicator takes a window length
+    windowed: bool = True
+
+
+INDICATORS = {
+    "sma": Indicator(
+        "Simple moving average of the closing price over the last n days",
+        f'CASE WHEN count("close") OVER ({LAST_N}) >= {{n}} THEN avg("close") OVER ({LAST_N}) END',
+    ),
+    "ema": Indicator(
+        "Exponential moving average of the closing price with a span of n days, i.e. a smoothing factor of 2 / (span + 1)",
+        # Older prices than 10 spans back weigh less than 1e-8 and are left out
+        f'list("close") OVER ({WINDOW} ROWS BETWEEN 10 * {{n}} PRECEDING AND CURRENT ROW)',
+        final="ema_of({column}, {n})",
+    ),
+    "returns": Indicator(
+        "Return of the closing price over the last n days, as a fraction (0.05 is 5%)",
+        f'"close" / lag("close", {{n}}) OVER ({WINDOW}) - 1',
+    ),
+    "volatility": Indicator(
+        "Standard deviation of the daily returns over the last n days, as a fraction",
+        f'CASE WHEN count("daily_return") OVER ({LAST_N}) >= {{n}} '
+        f'THEN stddev_samp("daily_return") OVER ({LAST_N}) END',
+    ),
+    "drawdown": Indicator(
+        "Decline of the closing price from its highest close so far, as a fraction (-0.2 is 20% below the peak)",
+        f'"close" / max("close") OVER ({WINDOW} ROWS UNBOUNDED PRECEDING) - 1',
+        windowed=False,
+    ),
+}
+
+# Columns of crypto_indicators: (indicator, window length)
+MATERIALIZED = {
+    "return_1d": ("returns", 1),
+    "return_7d": ("returns", 7),
+    "return_30d": ("returns", 30),
+    "sma_7": ("sma", 7),
+    "sma_30": ("sma", 30),
+    "sma_90": ("sma", 90),
+    "ema_12": ("ema", 12),
+    "ema_26": ("ema", 26),
+    "volatility_30": ("volatility", 30),
+    "drawdown": ("drawdown", None),
+}
+
+# Exponential moving average of a list of prices, oldest first. The oldest price
+# starts the average, so the weights add up to one.
+EMA_MACRO = """
+CREATE OR REPLACE TEMP MACRO ema_of(prices, n) AS list_inner_product(
+    CAST(prices AS DOUBLE[]),
+    CAST(list_transform(
+        range(len(prices)),
+        i -> CASE WHEN i = 0 THEN pow(1 - 2 / (n + 1), len(prices) - 1)
+             ELSE 2 / (n + 1) * pow(1 - 2 / (n + 1), len(prices) - 1 - i) END
+    ) AS DOUBLE[])
+)
+"""
+
+
+def _indicator_query(columns, source, keep=""):
+    """Selects symbol, date, the `keep` columns and the given {name: (indicator, n)} columns from `source`."""
+    windows = "".join(
+        ", " + INDICATORS[indicator].window.format(n=n) + f' AS "{name}"' for name, (indicator, n) in columns.items()
+    )
+    finals = "".join(
+        ", " + (INDICATORS[indicator].final or "{column}").format(column=f'"{name}"', n=n) + f' AS "{name}"'
+        for name, (indicator, n) in columns.items()
+    )
+    return f'SELECT "symbol", "date"{keep}{finals} FROM (SELECT "symbol", "date"{keep}{windows} FROM ({source}))'
+
+
+def _ema(symbols, prices, span):
+    """
+    EMA per symbol of prices sorted by symbol and date. The symbols are laid out
+    side by side and stepped through time together, so the loop runs once per
+    date rather than once per row.
+    """
+    starts = np.flatnonzero(np.r_[True, symbols[1:] != symbols[:-1]])
+    lengths = np.diff(np.r_[starts, len(prices)])
+    columns = np.repeat(np.arange(len(starts)), lengths)
+    rows = np.arange(len(prices)) - np.repeat(starts, lengths)
+    matrix = np.full((lengths.max(), len(starts)), np.nan)
+    matrix[rows, columns] = prices
+
+    alpha = 2 / (span + 1)
+    averages = np.empty_like(matrix)
+    average = matrix[0]
+    averages[0] = average
+    for t in range(1, len(matrix)):
+        price = matrix[t]
+        average = np.where(np.isnan(price), average, alpha * price + (1 - alpha) * average)
+        averages[t] = average
+    return averages[rows, columns]
+
+
+def register_macros(conn):
+    """
+    Registers the indicator macros on a connection or cursor. Temporary macros
+    are only visible to the cursor that created them.
+    """
+    conn.execute(EMA_MACRO)
+    for name, indicator in INDICATORS.items():
+        parameters = "n, sym := NULL" if indicator.windowed else "sym := NULL"
+        source = BASE_QUERY.format(where=' WHERE sym IS NULL OR "symbol" = sym')
+        query = _indicator_query({"value": (name, "n")}, source)
+        conn.execute(f"CREATE OR REPLACE TEMP MACRO {name}({parameters}) AS TABLE {query}")
+
+
+def describe_macros():
+    """Describes the macros for the planning prompt, see db.get_table_info."""
+    return {
+        name: (f"{name}(n, sym := NULL)" if indicator.windowed else f"{name}(sym := NULL)", indicator.description)
+        for name, indicator in INDICATORS.items()
+    }
+
+
+def materialize(conn, table_name="crypto_indicators"):
+    """Writes the MATERIALIZED columns for every symbol and date to `table_name`, sorted like crypto_data."""
+    in_sql = {name: spec for name, spec in MATERIALIZED.items() if INDICATORS[spec[0]].final is None}
+    query = _indicator_query(in_sql, BASE_QUERY.format(where=""), keep=', "close"')
+    result = conn.execute(f'{query} ORDER BY "symbol", "date"').arrow()
+
+    symbols = result["symbol"].to_numpy(zero_copy_only=False)
+    prices = result["close"].to_numpy(zero_copy_only=False).astype(np.float64)
+    columns = {"symbol": result["symbol"], "date": result["date"]}
+    for name, (indicator, n) in MATERIALIZED.items():
+        columns[name] = result[name] if name in in_sql else pa.array(_ema(symbols, prices, n))
+
+    conn.register("materialized_indicators", pa.table(columns))
+    conn.execute(f"CREATE OR REPLACE TABLE {table_name} AS SELECT * FROM materialized_indicators")
+    conn.unregister("materialized_indicators")
+    conn.execute(f"COMMENT ON COLUMN {table_name}.symbol IS 'The trading symbol of the cryptocurrency'")
+    conn.execute(f"COMMENT ON COLUMN {table_name}.date IS 'The date of the data point'")
+    for name, (indicator, n) in MATERIALIZED.items():
+        description = INDICATORS[indicator].description.replace("n days", f"{n} days").replace("'", "''")
+        conn.execute(f"COMMENT ON COLUMN {table_name}.{name} IS '{description}'")
@@ -0,0 +1,397 @@
+import asyncio
+import json
+from timeit import default_timer as timer
+from pydantic import BaseModel, Field, PrivateAttr
+from enum import Enum
+from typing import List, Optional
+from string import Template
+from visualization import (  # Import visualization functions
+    cached_figure_json,
+    data_hash,
+    extract_chart_data,
+    get_bar_chart,
+    get_candlestick_chart,
+    get_line_chart,
+    get_network_graph,
+    get_pie_chart,
+    to_columns,
+)
+from cancellation import record
+from forecast import forecast_series
+from fusion import group_tasks_by_table, run_fused
+from streaming import (
+    FETCH_BATCH_SIZE,
+    Collector,
+    LineDownsampler,
+    OhlcDownsampler,
+    SumAggregator,
+    read_batches,
+)
+
+# What the model has to provide for each chart type, see build_system_message
+CHART_PARAMETERS = {
+    "BAR_CHART": ("Bar chart tasks require a 'bar_mode', either \"group\" or \"stack\"", {"bar_mode": "group"}),
+    "PIE_CHART": ("Pie chart tasks require no parameters", {}),
+    "LINE_CHART": ("Line chart tasks require no parameters", {}),
+    "CANDLESTICK_CHART": ("Candlestick chart tasks require no parameters", {}),
+    "FORECAST": (
+        "Forecast tasks require a 'horizon', the number of future periods to forecast, and a 'method', either \"holt_winters\" "
+        "or \"linear\". Add a 'season_length' for Holt-Winters on data with a repeating pattern, e.g. 7 for a weekly pattern in daily data.",
+        {"horizon": 30, "method": "holt_winters", "season_length": 7},
+    ),
+    "NETWORK_GRAPH": (
+        "Network graph tasks require 'source_field', 'target_field' for the nodes, 'edge_field' for the edge weight, "
+        "and 'graph_type' to define the type of network graph (e.g., 'directed', 'undirected', 'weighted', 'clustered').",
+        {"source_field": "source", "target_field": "target", "edge_field": "value", "graph_type": "directed"},
+    ),
+}
+
+# Per chart type, the fields a task draws when the plan leaves them out. A dataset
+# can have its own (Dataset.default_fields), a group_field of None draws one series.
+CRYPTO_DEFAULT_FIELDS = {
+    "BAR_CHART": {"x_field": "date", "y_field": "value", "group_field": "symbol"},
+    "PIE_CHART": {"x_field": "symbol", "y_field": "value"},
+    "LINE_CHART": {"x_field": "date", "y_field": "value", "group_field": "symbol"},
+    "CANDLESTICK_CHART": {"x_field": "date", "group_field": "symbol"},
+    "FORECAST": {"x_field": "date", "y_field": "value", "group_field": "symbol"},
+}
+
+CRYPTO_QUERY_RULES = """
+For forecasting tasks, use a FORECAST task whose query returns the history to forecast. Never combine multiple values (e.g. price and volume) in one query, every crypto in the query gets its own forecast.
+
+When generating the SQL queries, follow the instructions below:
+- Remember to aggregate when possible to return only the necessary number of rows.
+- Never query for all columns from a table. You must query only the columns that are needed to answer the question. Wrap each column name in double quotes (") to denote them as delimited identifiers.
+- Pay attention to use only the column names you can see in the table given below. Be careful to not query for columns that do not exist. Also, pay attention to which column is in which table.
+- If the question involves "today", remember to use the CURRENT_DATE function.
+- Always include the "symbol" column in the query.
+- Always use the alias "value" for the numerical value in the query, whether it's a price or volume.
+- Always use the alias "date" for the date column in the query.
+- For candlestick charts, query the "open", "high", "low" and "close" columns under their own names instead of a "value".
+- Filter on "symbol" and ranges of "date" where possible, the table is stored sorted by both so these filters skip most of it.
+- For moving averages, returns, volatility and drawdowns, never write window functions yourself. Select the matching column of crypto_indicators if there is one, otherwise use the table macros, e.g. SELECT "symbol", "date", "value" FROM sma(50, sym := 'BTC'). Pass sym when the question is about one crypto.
+- Write the SQL query without formatting it in a code block.
+"""
+
+system_message_template = Template(
+"""
+You are a DuckDB and data visualization expert. Given a data visualization request, you return a visualization plan consisting of visualization tasks.
+Each visualization task consists of:
+1. Syntactically correct SQL query to get the data necessary to answer the request.
+2. The correct visualization type to use ($chart_types), with the required parameters. 
+3. Parameters for the task, as a dictionary:
+$parameter_rules
+$fields_rule
+Example parameters:
+$parameter_examples
+
+You will NEVER return a visualization task with empty parameters.
+$query_rules
+Think step by step before writing the query plan.
+"""
+)
+
+
+def build_system_message(chart_types, query_rules, fields=False):
+    """
+    Builds the planning prompt for a dataset from the chart types it allows and
+    its own SQL rules. With `fields` the model also picks the chart's x, y and
+    group fields instead of relying on the "date", "value" and "symbol" aliases.
+    """
+    chart_types = [VisualizationType(chart_type).value for chart_type in chart_types]
+    names = ", ".join(chart_types[:-1]) + f", or {chart_types[-1]}" if len(chart_types) > 1 else chart_types[0]
+    return system_message_template.substitute(
+        chart_types=names,
+        parameter_rules="\n".join(f"    - {CHART_PARAMETERS[chart_type][0]}" for chart_type in chart_types),
+        fields_rule="4. The x-axis field, y-axis field, and group field (if applicable) for the chart.\n" if fields else "",
+        parameter_examples="\n".join(
+            f"    - {chart_type.replace('_', ' ').lower()}: {json.dumps(CHART_PARAMETERS[chart_type][1])}"
+            for chart_type in chart_types
+            if CHART_PARAMETERS[chart_type][1]
+        ),
+        query_rules=query_rules,
+    )
+
+
+request_prompt_template = Template(
+"""
+Request: $input
+
+Use the following tables:
+$table_info
+
+"""
+)
+
+async def async_generate_visualization_plan(client, table_info, question, token, model="gpt-4o", system_message=None):
+    """
+    Streams partial visualization plans for `question`.
+
+    The LLM stream is closed as soon as the token is cancelled or the consumer
+    stops iterating, so abandoned requests stop consuming tokens.
+    """
+    # instructor (and openai behind it) is slow to import and only needed to generate plans
+    import instructor
+
+    plan = await client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_message or analysis_system_message},
+            {
+                "role": "user",
+                "content": request_prompt_template.substitute(
+                    input=question, table_info=table_info
+                ),
+            },
+        ],
+        stream=True,
+        response_model=instructor.Partial[VisualizationPlan],
+    )
+    finished = False
+    # Cancelling the token from another thread aborts the pending read on the stream.
+    # The reading task can change between partials, e.g. when routing.py reads the
+    # first one in a task of its own, so the current one is looked up on cancel.
+    reader = {"task": asyncio.current_task()}
+    loop = asyncio.get_running_loop()
+    try:
+        with token.on_cancel(lambda: loop.call_soon_threadsafe(lambda: reader["task"].cancel())):
+            async for obj in plan:
+                if token.cancelled:
+                    break
+                yield obj
+                reader["task"] = asyncio.current_task()
+            finished = not token.cancelled
+    except asyncio.CancelledError:
+        if not token.cancelled:
+            raise
+    finally:
+        if not finished:
+            # Closing the generator closes the HTTP response, so no more tokens are billed
+            await plan.aclose()
+            record("streams_closed_early")
+
+
+class VisualizationType(Enum):
+    BAR_CHART = "BAR_CHART"
+    PIE_CHART = "PIE_CHART"
+    LINE_CHART = "LINE_CHART"  # Added LINE_CHART
+    NETWORK_GRAPH = "NETWORK_GRAPH"
+    CANDLESTICK_CHART = "CANDLESTICK_CHART"
+    FORECAST = "FORECAST"
+
+
+CRYPTO_CHART_TYPES = [
+    VisualizationType.BAR_CHART,
+    VisualizationType.PIE_CHART,
+    VisualizationType.LINE_CHART,
+    VisualizationType.CANDLESTICK_CHART,
+    VisualizationType.FORECAST,
+]
+
+analysis_system_message = build_system_message(CRYPTO_CHART_TYPES, CRYPTO_QUERY_RULES)
+
+
+class VisualizationTask(BaseModel):
+    query: str = Field(
+        ..., description="SQL query to fetch data for visualization"
+    )
+    type: VisualizationType
+    title: str = Field(..., description="Title of the visualization")
+    parameters: dict = Field(
+        ..., description="Parameters for the visualization task, as a dictionary"
+    )
+    x_field: Optional[str] = Field(None, description="Field for the x-axis")
+    y_field: Optional[str] = Field(None, description="Field for the y-axis")
+    group_field: Optional[str] = Field(None, description="Field for grouping data")
+    # The dataset's default fields, set by VisualizationPlan.prepare
+    _default_fields: dict = PrivateAttr(default_factory=lambda: CRYPTO_DEFAULT_FIELDS)
+
+    def _field(self, field):
+        defaults = self._default_fields.get(self.type.value, CRYPTO_DEFAULT_FIELDS.get(self.type.value, {}))
+        return getattr(self, field) or defaults.get(field)
+
+    def _reducer(self):
+        """The streaming reducer that keeps what this task's chart draws, see streaming.py."""
+        x_field, y_field, group_field = self._field("x_field"), self._field("y_field"), self._field("group_field")
+        if self.type == VisualizationType.LINE_CHART:
+            return LineDownsampler(x_field, y_field, group_field)
+        if self.type == VisualizationType.BAR_CHART:
+            return SumAggregator([field for field in (group_field, x_field) if field], y_field)
+        if self.type == VisualizationType.PIE_CHART:
+            return SumAggregator([x_field], y_field)
+        if self.type == VisualizationType.CANDLESTICK_CHART:
+            return OhlcDownsampler(x_field, group_field)
+        # Forecasts and network graphs need every row
+        return Collector()
+
+    def _execute_query(self, pool, token):
+        # Each query holds a cursor of its own while it runs, so interrupting it does not affect other requests
+        reducer = self._reducer()
+        with pool.cursor() as cursor:
+            try:
+                with token.on_cancel(cursor.interrupt):
+                    cursor.execute(self.query)
+                    # Record batches are reduced as they arrive, the full result is never held
+                    for columns in read_batches(cursor):
+                        if token.cancelled:
+                            break
+                        reducer.add(columns)
+            except Exception as e:
+                if token.cancelled:
+                    record("queries_interrupted")
+                else:
+                    print(f"An error occurred: {e}")
+                return {}
+        return reducer.columns()
+
+    def _fields(self, **names):
+        # Fields the plan left out fall back to the dataset's defaults
+        return {name: self._field(field) for name, field in names.items()}
+
+    def get_figure(self, data):
+        if self.type == VisualizationType.BAR_CHART:
+            return get_bar_chart(
+                data=data, title=self.title, barmode=self.parameters.get("bar_mode"),
+                **self._fields(x_field="x_field", y_field="y_field", group_field="group_field"),
+            )
+
+        elif self.type == VisualizationType.PIE_CHART:
+            return get_pie_chart(
+                data=data, title=self.title, **self._fields(value_field="y_field", name_field="x_field")
+            )
+
+        elif self.type == VisualizationType.LINE_CHART:  # Handling LINE_CHART
+            return get_line_chart(
+                data=data, title=self.title,
+                **self._fields(x_field="x_field", y_field="y_field", group_field="group_field"),
+            )
+
+        elif self.type == VisualizationType.CANDLESTICK_CHART:
+            return get_candlestick_chart(
+                data=data, title=self.title, **self._fields(x_field="x_field", group_field="group_field")
+            )
+
+        elif self.type == VisualizationType.FORECAST:
+            fields = self._fields(x_field="x_field", y_field="y_field", group_field="group_field")
+            columns = to_columns(data)
+            series = extract_chart_data(columns, fields["x_field"], fields["y_field"], fields["group_field"])
+            if not fields["group_field"]:
+                series = {None: series}
+            start = timer()
+            try:
+                forecast = forecast_series(
+                    series,
+                    horizon=self.parameters.get("horizon", 30),
+                    method=self.parameters.get("method", "holt_winters"),
+                    season_length=self.parameters.get("season_length"),
+                    level=self.parameters.get("level", 0.95),
+                )
+                print(f"Forecast {len(series)} series in {round(timer() - start, 3)} seconds")
+            except (TypeError, ValueError) as e:
+                # Still show the history when the parameters are unusable
+                print(f"Forecast failed: {e}")
+                forecast = None
+            return get_line_chart(data=columns, title=self.title, forecast=forecast, **fields)
+
+        elif self.type == VisualizationType.NETWORK_GRAPH:
+            return get_network_graph(
+                data=data,
+                title=self.title,
+                source_field=self.parameters.get("source_field", "source"),
+                target_field=self.parameters.get("target_field", "target"),
+                edge_field=self.parameters.get("edge_field", "value"),
+                graph_type=self.parameters.get("graph_type", "undirected"),
+            )
+
+    def run(self, pool, token, data=None):
+        """
+        Returns the task's figure as JSON, or None if there is no data or the token
+        was cancelled. Figures are cached by task and data, so reruns of the same
+        plan over unchanged data skip building and serializing them.
+        """
+        if data is None:
+            columns = self._execute_query(pool, token)
+        else:
+            reducer = self._reducer()
+            reducer.add(to_columns(data))
+            columns = reducer.columns()
+        if token.cancelled:
+            return None
+        if not columns or not len(next(iter(columns.values()))):
+            return None
+
+        key = (
+            self.query,
+            self.type.value,
+            self.title,
+            json.dumps(self.parameters, sort_keys=True, default=str),
+            (self._field("x_field"), self._field("y_field"), self._field("group_field")),
+            data_hash(columns),
+        )
+        return cached_figure_json(key, lambda: self.get_figure(columns))
+
+
+class VisualizationPlan(BaseModel):
+    plan: List[VisualizationTask]
+
+    def prepare(self, chart_types, task_overrides=None, default_fields=None):
+        """
+        Returns the plan limited to `chart_types`, with the dataset's fixed fields
+        and default parameters applied per chart type. Fields a task leaves out
+        are taken from `default_fields` when it draws, see CRYPTO_DEFAULT_FIELDS.
+        """
+        allowed = {VisualizationType(chart_type) for chart_type in chart_types}
+        tasks = []
+        for task in self.plan:
+            if task.type not in allowed:
+                record("tasks_rejected")
+                continue
+            overrides = dict((task_overrides or {}).get(task.type.value, {}))
+            defaults = overrides.pop("parameters", None)
+            task = task.model_copy(update=overrides)
+            if not task.parameters and defaults:
+                task.parameters = dict(defaults)
+            if default_fields is not None:
+                task._default_fields = default_fields
+            tasks.append(task)
+        return VisualizationPlan(plan=tasks)
+
+    def _execute_fused(self, pool, table_columns, token):
+        """
+        Runs filtered tasks that scan the same table as one fused query, see
+        fusion.run_fused. Returns the data keyed by task index; tasks missing from the
+        result run their own query, once.
+        """
+        queries = [task.query for task in self.plan]
+        results = {}
+        for table_name, indexes in group_tasks_by_table(queries, list(table_columns)).items():
+            if len(indexes) < 2:
+                continue
+            with pool.cursor() as cursor:
+                try:
+                    start = timer()
+                    with token.on_cancel(cursor.interrupt):
+                        fused = run_fused(
+                            cursor, [queries[i] for i in indexes], table_name, table_columns[table_name],
+                            max_rows=FETCH_BATCH_SIZE,
+                        )
+                    results.update((indexes[position], rows) for position, rows in fused.items())
+                    if fused:
+                        print(f"Fused {len(fused)} tasks on {table_name} in {round(timer() - start, 3)} seconds")
+                except Exception as e:
+                    if token.cancelled:
+                        record("queries_interrupted")
+                        return results
+                    # One bad query should not take the other charts down with it
+                    print(f"Fused query on {table_name} failed, running tasks separately: {e}")
+        return results
+
+    def run(self, pool, table_columns, token):
+        """Yields (task index, figure JSON) in plan order until the token is cancelled."""
+        results = self._execute_fused(pool, table_columns, token)
+        num_tasks = len(self.plan)
+        for task_index, task in enumerate(self.plan):
+            if token.cancelled:
+                record("tasks_skipped", num_tasks - task_index)
+                return
+            yield task_index, task.run(pool, token, data=results.get(task_index))
@@ -0,0 +1,268 @@
+"""
+Chooses the model that generates each plan, from the question and the latency
+and errors recently seen per model.
+
+Every dataset has a strong model (Dataset.model) and a fast one (Dataset.fast_model).
+Short questions about one series go to the fast model and the rest to the strong
+one, unless the preferred model is currently failing often or slower than the
+timeout. The plan then streams from that model, with two safety nets:
+- hedging: if it has not streamed its first partial plan by its recent 95th
+  percentile time to first partial, the other model is started as well and the
+  first one to stream a partial is kept, the other stream is closed
+- fallback: if it fails or times out before its first partial, the other model
+  takes over
+"""
+import asyncio
+import re
+from collections import defaultdict, deque
+from dataclasses import asdict, dataclass
+from typing import Optional
+
+import numpy as np
+from decouple import config
+
+from cancellation import record
+from plan import async_generate_visualization_plan
+
+# Seconds to the first partial plan before the other model is started as well,
+# until a model has MIN_SAMPLES requests to take its 95th percentile from
+HEDGE_AFTER = config("PLAN_HEDGE_AFTER", default=3.0, cast=float)
+# Seconds to the first partial plan before a model counts as failed
+PLAN_TIMEOUT = config("PLAN_TIMEOUT", default=20.0, cast=float)
+# Questions scoring at least this go to the strong model, see complexity
+COMPLEXITY = config("PLAN_COMPLEXITY", default=2, cast=int)
+# Recent requests per model that the latency and error rate are taken from
+WINDOW = 50
+MIN_SAMPLES = 10
+# Preferred models failing more often than this are passed over
+MAX_ERROR_RATE = 0.5
+
+# Words that ask for more than one plain series
+COMPLEX_WORDS = re.compile(
+    r"\b(compar\w*|vs|versus|correlat\w*|forecast\w*|predict\w*|ratio|rank\w*|top|each|per|relative|"
+    r"between|trend\w*|growth|breakdown|network|distribution|against)\b",
+    re.IGNORECASE,
+)
+
+
+def complexity(question):
+    """
+    Scores how much a question asks for: one point per word from COMPLEX_WORDS,
+    per "and" or comma, and per 12 words.
+    """
+    return (
+        len(COMPLEX_WORDS.findall(question))
+        + len(re.findall(r"\band\b|,", question, re.IGNORECASE))
+        + len(question.split()) // 12
+    )
+
+
+class ModelStats:
+    """
+    Times to the first partial plan and failures of a model's recent requests.
+    Requests stopped before their first partial, because the other model won or
+    the client left, only tell that the model would have taken longer than it
+    had, so they are kept apart from the latencies and the error rate.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.failures = deque(maxlen=window)
+        self.censored = deque(maxlen=window)
+
+    def succeeded(self, seconds):
+        self.latencies.append(seconds)
+        self.failures.append(False)
+
+    def failed(self):
+        self.failures.append(True)
+
+    def stopped(self, seconds):
+        self.censored.append(seconds)
+
+    @property
+    def error_rate(self):
+        return sum(self.failures) / len(self.failures) if len(self.failures) >= MIN_SAMPLES else 0.0
+
+    def percentile(self, q):
+        return float(np.percentile(self.latencies, q)) if len(self.latencies) >= MIN_SAMPLES else None
+
+    def summary(self):
+        return {
+            "requests": len(self.failures),
+            "stopped": len(self.censored),
+            "error_rate": round(self.error_rate, 3),
+            "p50_seconds": self.percentile(50),
+            "p95_seconds": self.percentile(95),
+        }
+
+
+@dataclass
+class Route:
+    """The models chosen for one question and what happened to them."""
+    question: str
+    primary: str
+    secondary: Optional[str]
+    reason: str
+    # The model whose plan was kept, once it streams its first partial
+    model: Optional[str] = None
+    hedged: bool = False
+    fallback: bool = False
+    first_partial_seconds: Optional[float] = None
+
+    def to_dict(self):
+        return {name: value for name, value in asdict(self).items() if name != "question"}
+
+
+class _Attempt:
+    # One model's stream and the task reading its first partial
+    def __init__(self, stream, started):
+        self.stream = stream
+        self.first = asyncio.ensure_future(anext(stream))
+        self.started = started
+
+    async def close(self):
+        if not self.first.done():
+            self.first.cancel()
+        # The generator cannot be closed while the task is still reading from it
+        await asyncio.gather(self.first, return_exceptions=True)
+        await self.stream.aclose()
+
+
+class ModelRouter:
+    """
+    Routes plan generation between two models, see the module docstring. One
+    router is shared by every dataset in the process, so the statistics of a
+    model include all its requests.
+    """
+
+    def __init__(self, hedge_after=HEDGE_AFTER, timeout=PLAN_TIMEOUT, threshold=COMPLEXITY):
+        self.hedge_after = hedge_after
+        self.timeout = timeout
+        self.threshold = threshold
+        self.stats = defaultdict(ModelStats)
+
+    def _usable(self, model):
+        stats = self.stats[model]
+        p95 = stats.percentile(95)
+        return stats.error_rate <= MAX_ERROR_RATE and (p95 is None or p95 < self.timeout)
+
+    def choose(self, question, model, fast_model=None):
+        """Picks the primary model for `question`, the other one hedges and takes over on failures."""
+        if not fast_model or fast_model == model:
+            return Route(question, model, None, "single model")
+        score = complexity(question)
+        primary, secondary = (model, fast_model) if score >= self.threshold else (fast_model, model)
+        reason = f"complexity {score}"
+        if not self._usable(primary) and self._usable(secondary):
+            primary, secondary = secondary, primary
+            reason += f", {secondary} is failing or slow"
+        return Route(question, primary, secondary, reason)
+
+    def hedge_deadline(self, model):
+        p95 = self.stats[model].percentile(95)
+        return min(p95 if p95 is not None else self.hedge_after, self.timeout)
+
+    async def generate(self, route, client, table_info, token, system_message=None):
+        """
+        Streams partial plans like async_generate_visualization_plan, from
+        whichever model of `route` streams first. Sets route.model before the first
+        partial is yielded, and raises the last error if no model streams a plan.
+        """
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        attempts = {}
+        finished = set()
+        error = None
+        winner = None
+
+        def launch(model):
+            attempts[model] = _Attempt(
+                async_generate_visualization_plan(
+                    client, table_info, route.question, token, model=model, system_message=system_message
+                ),
+                loop.time(),
+            )
+
+        launch(route.primary)
+        hedge_at = start + self.hedge_deadline(route.primary)
+        task = asyncio.current_task()
+        try:
+            # Cancelling the token also ends the wait for the first partial
+            with token.on_cancel(lambda: loop.call_soon_threadsafe(task.cancel)):
+                while winner is None and not token.cancelled:
+                    running = {model: attempt for model, attempt in attempts.items() if model not in finished}
+                    can_add = route.secondary is not None and route.secondary not in attempts
+                    if not running:
+                        if not can_add:
+                            raise error or RuntimeError("No model streamed a plan")
+                        launch(route.secondary)
+                        route.fallback = True
+                        record("plans_fallen_back")
+                        continue
+
+                    wakeups = [attempt.started + self.timeout for attempt in running.values()]
+                    if can_add:
+                        wakeups.append(hedge_at)
+                    await asyncio.wait(
+                        [attempt.first for attempt in running.values()],
+                        timeout=max(min(wakeups) - loop.time(), 0),
+                        return_when=asyncio.FIRST_COMPLETED,
+                    )
+
+                    now = loop.time()
+                    for model, attempt in running.items():
+                        if attempt.first.cancelled():
+                            # Only cancelling the token does that, the loop ends with it
+                            finished.add(model)
+                            continue
+                        if attempt.first.done():
+                            finished.add(model)
+                            exception = attempt.first.exception()
+                            if exception is None:
+                                self.stats[model].succeeded(now - attempt.started)
+                                if winner is None:
+                                    winner = model
+                                continue
+                            error = exception if not isinstance(exception, StopAsyncIteration) else \
+                                RuntimeError(f"{model} streamed no plan")
+                        elif now - attempt.started >= self.timeout:
+                            finished.add(model)
+                            await attempt.close()
+                            error = TimeoutError(f"{model} streamed no plan within {self.timeout} seconds")
+                        else:
+                            continue
+                        self.stats[model].failed()
+                        record("plan_model_failures")
+                        print(f"Plan from {model} failed: {error}")
+
+                    if winner is None and can_add and now >= hedge_at and len(finished) < len(attempts):
+                        launch(route.secondary)
+                        route.hedged = True
+                        record("plans_hedged")
+        except asyncio.CancelledError:
+            if not token.cancelled:
+                raise
+        finally:
+            for model, attempt in attempts.items():
+                if model != winner:
+                    if model not in finished:
+                        # Lost the race or was cancelled, its latency is unknown
+                        self.stats[model].stopped(loop.time() - attempt.started)
+                    await attempt.close()
+
+        if winner is None:
+            return
+        route.model = winner
+        route.first_partial_seconds = round(loop.time() - start, 3)
+        record(f"plans_from_{winner}")
+        stream = attempts[winner].stream
+        try:
+            yield attempts[winner].first.result()
+            async for obj in stream:
+                yield obj
+        finally:
+            await stream.aclose()
+
+    def summary(self):
+        return {model: stats.summary() for model, stats in self.stats.items()}
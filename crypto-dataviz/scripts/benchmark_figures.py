@@ -0,0 +1,97 @@
+"""
+Compares the size and serialization time of line chart payloads.
+
+    python scripts/benchmark_figures.py --points 20000 --series 3
+
+Builds a line chart of --series daily series of --points points each, with two
+kinds of values: doubles at full precision and prices in cents. Each is
+serialized the way the charts used to be, as Python lists of floats and date
+strings through fig.to_json(), and then:
+- typed: figure_to_json, typed arrays without the template, as the API sends it
+- with template: what batch.py writes, see with_template
+- served: what a line chart task sends, downsampled to MAX_POINTS per series by
+  its reducer (streaming.py) before figure_to_json
+
+Typed arrays cost 10.7 characters per double whatever its value, so they save
+the most on long numbers: about 3x on full precision doubles, 2x on prices in
+cents. Exits with an error if the served payload is not at least 3x smaller than
+the old one, or not faster to build and serialize.
+"""
+import argparse
+import os
+import sys
+from timeit import default_timer as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import plotly.graph_objects as go
+
+from streaming import LineDownsampler
+from visualization import figure_to_json, get_line_chart, to_columns, with_template
+
+
+def columns(points, series, values):
+    days = np.arange(np.datetime64("2000-01-01"), np.datetime64("2000-01-01") + points)
+    return {
+        "date": np.tile(days, series),
+        "value": values,
+        "symbol": np.repeat(np.array([f"S{i}" for i in range(series)], dtype=object), points),
+    }
+
+
+def old_json(data):
+    # Python lists into Plotly, as the chart builders did before typed arrays
+    traces = []
+    for symbol in dict.fromkeys(data["symbol"]):
+        mask = data["symbol"] == symbol
+        traces.append(go.Scatter(
+            name=symbol, x=[str(day) for day in data["date"][mask]], y=data["value"][mask].tolist(), mode="lines"
+        ))
+    return go.Figure(traces).to_json()
+
+
+def served_json(data):
+    reducer = LineDownsampler("date", "value", "symbol")
+    reducer.add(to_columns(data))
+    return figure_to_json(get_line_chart(reducer.columns(), "Benchmark"))
+
+
+def timed(build):
+    start = timer()
+    result = build()
+    return result, timer() - start
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark line chart payloads")
+    parser.add_argument("--points", type=int, default=20000, help="Points per series")
+    parser.add_argument("--series", type=int, default=3)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    size = args.points * args.series
+    value_kinds = {
+        "full precision": 100 + rng.random(size),
+        "cents": np.round(30000 + rng.random(size) * 40000, 2),
+    }
+    print(f"{'values':<15} {'payload':<14} {'bytes':>11} {'smaller':>8} {'seconds':>8}")
+    failed = False
+    for kind, values in value_kinds.items():
+        data = columns(args.points, args.series, values)
+        old, old_seconds = timed(lambda: old_json(data))
+        typed, typed_seconds = timed(lambda: figure_to_json(get_line_chart(data, "Benchmark")))
+        templated, templated_seconds = timed(lambda: with_template(figure_to_json(get_line_chart(data, "Benchmark"))))
+        served, served_seconds = timed(lambda: served_json(data))
+        for name, payload, seconds in (
+            ("lists", old, old_seconds),
+            ("typed", typed, typed_seconds),
+            ("with template", templated, templated_seconds),
+            ("served", served, served_seconds),
+        ):
+            print(f"{kind:<15} {name:<14} {len(payload):>11,} {len(old) / len(payload):>7.2f}x {seconds:>8.3f}")
+        if len(old) / len(served) < 3 or served_seconds >= old_seconds:
+            print(f"{kind}: the served payload is not 3x smaller and faster than the lists")
+            failed = True
+    sys.exit(1 if failed else 0)
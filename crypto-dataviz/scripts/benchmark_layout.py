@@ -0,0 +1,90 @@
+"""
+Benchmarks date-range queries on crypto_data with and without the sorted layout.
+
+    python scripts/benchmark_layout.py --symbols 2000 --days 5000
+
+Builds a synthetic crypto_data with symbols x days rows (10M by default) twice in a
+temporary database: once in arbitrary order, and once sorted by symbol and date the
+way scripts/load_data.py writes it. Then prints the median latency of typical range
+queries on both. With the sorted layout each row group covers one symbol and a
+narrow date range, so DuckDB's min/max zone maps skip the row groups outside it.
+"""
+import argparse
+import os
+import statistics
+import tempfile
+from timeit import default_timer as timer
+
+import duckdb
+
+QUERIES = {
+    "one symbol, 30 days": """
+        SELECT "date", "close" AS "value" FROM {table}
+        WHERE "symbol" = 'S42' AND "date" BETWEEN DATE '2030-01-01' AND DATE '2030-01-30'
+    """,
+    "one symbol, 1 year": """
+        SELECT date_trunc('month', "date") AS "date", avg("close") AS "value" FROM {table}
+        WHERE "symbol" = 'S42' AND "date" BETWEEN DATE '2030-01-01' AND DATE '2030-12-31'
+        GROUP BY ALL
+    """,
+    "all symbols, 30 days": """
+        SELECT "symbol", sum("volume") AS "value" FROM {table}
+        WHERE "date" BETWEEN DATE '2030-01-01' AND DATE '2030-01-30'
+        GROUP BY ALL
+    """,
+    "one symbol, all days": """
+        SELECT max("high") AS "value" FROM {table} WHERE "symbol" = 'S42'
+    """,
+}
+
+
+def build(conn, symbols, days):
+    conn.execute(f"""
+        CREATE TABLE source AS
+        SELECT
+            DATE '2020-01-01' + CAST(d AS INTEGER) AS date,
+            100 + random() AS open,
+            101 + random() AS high,
+            99 + random() AS low,
+            100 + random() AS close,
+            random() * 1e9 AS volume,
+            'S' || s AS symbol
+        FROM range({symbols}) AS t1(s), range({days}) AS t2(d)
+    """)
+    # Arbitrary order, like rows appended from several feeds at once
+    conn.execute("CREATE TABLE unsorted AS SELECT * FROM source ORDER BY hash(symbol, date)")
+    conn.execute("CREATE TABLE sorted AS SELECT * FROM source ORDER BY symbol, date")
+    conn.execute("DROP TABLE source")
+    conn.execute("CHECKPOINT")
+
+
+def measure(conn, query, repeat):
+    conn.execute(query).fetchall()
+    timings = []
+    for _ in range(repeat):
+        start = timer()
+        conn.execute(query).fetchall()
+        timings.append(timer() - start)
+    return statistics.median(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark range queries on sorted and unsorted layouts")
+    parser.add_argument("--symbols", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "layout.duckdb")
+        start = timer()
+        with duckdb.connect(db_path) as conn:
+            build(conn, args.symbols, args.days)
+        print(f"Built {args.symbols * args.days:,} rows per layout in {round(timer() - start, 1)} seconds")
+
+        with duckdb.connect(db_path, read_only=True) as conn:
+            print(f"{'query':<24} {'unsorted':>10} {'sorted':>10} {'speedup':>8}")
+            for name, query in QUERIES.items():
+                unsorted = measure(conn, query.format(table="unsorted"), args.repeat)
+                clustered = measure(conn, query.format(table="sorted"), args.repeat)
+                print(f"{name:<24} {unsorted * 1000:>8.1f}ms {clustered * 1000:>8.1f}ms {unsorted / clustered:>7.1f}x")
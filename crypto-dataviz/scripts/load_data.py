@@ -1,5 +1,10 @@
+import os
+import sys
 import duckdb
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from indicators import materialize
+
 # Connect to DuckDB (this will create a new file 'crypto_data.duckdb' if it does not exist)
 conn = duckdb.connect('data/crypto_data.duckdb')
 
@@ -8,6 +13,7 @@ create_tbl_query = """
 DROP TABLE IF EXISTS crypto_data;
 CREATE TABLE crypto_data (
     date DATE,
+    open DOUBLE,
     high DOUBLE,
     low DOUBLE,
     close DOUBLE,
@@ -16,6 +22,7 @@ CREATE TABLE crypto_data (
 );
 
 COMMENT ON COLUMN crypto_data.date IS 'The date of the data point';
+COMMENT ON COLUMN crypto_data.open IS 'The opening price for the crypto on the date';
 COMMENT ON COLUMN crypto_data.high IS 'The high price for the crypto on the date';
 COMMENT ON COLUMN crypto_data.low IS 'The low price for the crypto on the date';
 COMMENT ON COLUMN crypto_data.close IS 'The closing price for the crypto on the date';
@@ -24,11 +31,15 @@ COMMENT ON COLUMN crypto_data.symbol IS 'The trading symbol of the cryptocurrenc
 """
 conn.execute(create_tbl_query)
 
-# Read and insert the data from CSV files directly into DuckDB
+# Read and insert the data from CSV files directly into DuckDB. The rows are written
+# sorted by symbol and date, so each row group covers one symbol and a narrow date
+# range, and DuckDB's min/max zone maps skip the row groups outside a queried range.
 read_insert_query = """
 INSERT INTO crypto_data
+SELECT * FROM (
 SELECT 
     CAST(timestamp AS DATE) AS date,
+    open AS open,
     high AS high,
     low AS low,
     close AS close,
@@ -38,6 +49,7 @@ FROM read_csv_auto('data/bitcoin_data.csv', delim=';')
 UNION ALL
 SELECT 
     CAST(timestamp AS DATE) AS date,
+    open AS open,
     high AS high,
     low AS low,
     close AS close,
@@ -47,17 +59,24 @@ FROM read_csv_auto('data/ethereum_data.csv', delim=';')
 UNION ALL
 SELECT 
     CAST(timestamp AS DATE) AS date,
+    open AS open,
     high AS high,
     low AS low,
     close AS close,
     volume AS volume,
     'SOL' AS symbol
-FROM read_csv_auto('data/solana_data.csv', delim=';');
+FROM read_csv_auto('data/solana_data.csv', delim=';')
+)
+ORDER BY symbol, date;
 """
 conn.execute(read_insert_query)
 
+# Precompute the common indicator windows, so charts of them are lookups
+materialize(conn)
+
 # Verify the table
 print(conn.execute("SELECT * FROM crypto_data LIMIT 5").fetchall())
+print(conn.execute("SELECT * FROM crypto_indicators LIMIT 5").fetchall())
 
 # Close the connection
 conn.close()
@@ -0,0 +1,152 @@
+"""
+A local stand-in for the OpenAI chat completions API with injected latency, to
+try plan routing without an API key or network access.
+
+    python scripts/mock_openai.py --port 8100 --model gpt-4o=2.0 --model gpt-4o-mini=0.5 --slow 0.1 --errors 0.05
+
+Point the API or batch.py at it with OPENAI_BASE_URL=http://localhost:8100/v1 and
+any OPENAI_API_KEY. Every request is answered with the same plan, as a tool call
+the way instructor asks for it, streamed in small chunks when requested. The time
+to the first chunk varies around the model's median, --slow makes that share of
+requests --slow-factor times slower and --errors fails that share with a 500.
+--failing fails every request for a model. The app counts the requests per model
+in app.state.requests, and the streams the client closed before their end in
+app.state.closed_early.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+PLAN = {
+    "plan": [
+        {
+            "query": 'SELECT "symbol", "date", "close" AS "value" FROM crypto_data WHERE "symbol" = \'BTC\' '
+                     'AND "date" >= CURRENT_DATE - INTERVAL 30 DAY ORDER BY "date"',
+            "type": "LINE_CHART",
+            "title": "BTC closing price, last 30 days",
+            "parameters": {},
+        },
+    ]
+}
+# Seconds between streamed chunks, and characters per chunk
+CHUNK_INTERVAL = 0.01
+CHUNK_SIZE = 40
+
+
+def create_app(
+    latencies, default_latency=1.0, slow=0.0, slow_factor=4.0, errors=0.0, plan=None, seed=None, failing=(),
+):
+    """
+    Builds the stand-in. `latencies` is the median seconds to the first chunk per
+    model name, other models take `default_latency`. Models in `failing` always
+    answer with a 500.
+    """
+    rng = random.Random(seed)
+    requests = Counter()
+    closed_early = Counter()
+    arguments = json.dumps(plan or PLAN)
+
+    def chunk(model, delta, finish_reason=None):
+        return "data: " + json.dumps({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }) + "\n\n"
+
+    async def completions(request: Request):
+        body = await request.json()
+        model = body.get("model", "")
+        tool_name = body["tools"][0]["function"]["name"] if body.get("tools") else None
+        requests[model] += 1
+        delay = latencies.get(model, default_latency) * rng.lognormvariate(0, 0.25)
+        if rng.random() < slow:
+            delay *= slow_factor
+        if rng.random() < errors or model in failing:
+            await asyncio.sleep(delay / 2)
+            return JSONResponse({"error": {"message": "Injected failure", "type": "server_error"}}, status_code=500)
+
+        def tool_call(piece, first):
+            call = {"index": 0, "function": {"arguments": piece}}
+            if first:
+                call.update(id="call_mock", type="function")
+                call["function"]["name"] = tool_name
+            return call
+
+        if not body.get("stream"):
+            await asyncio.sleep(delay)
+            message = {"role": "assistant", "content": None if tool_name else arguments}
+            if tool_name:
+                message["tool_calls"] = [{
+                    "id": "call_mock", "type": "function", "function": {"name": tool_name, "arguments": arguments},
+                }]
+            return JSONResponse({
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": message, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+        async def events():
+            finished = False
+            try:
+                await asyncio.sleep(delay)
+                for start in range(0, len(arguments), CHUNK_SIZE):
+                    piece = arguments[start:start + CHUNK_SIZE]
+                    delta = {"tool_calls": [tool_call(piece, start == 0)]} if tool_name else {"content": piece}
+                    if start == 0:
+                        delta["role"] = "assistant"
+                    yield chunk(model, delta)
+                    await asyncio.sleep(CHUNK_INTERVAL)
+                yield chunk(model, {}, "stop")
+                yield "data: [DONE]\n\n"
+                finished = True
+            finally:
+                # Starlette cancels the stream when the client disconnects
+                if not finished:
+                    closed_early[model] += 1
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    app = Starlette(routes=[Route("/v1/chat/completions", completions, methods=["POST"])])
+    app.state.requests = requests
+    app.state.closed_early = closed_early
+    return app
+
+
+def parse_latencies(values):
+    latencies = {}
+    for value in values or []:
+        model, seconds = value.rsplit("=", 1)
+        latencies[model] = float(seconds)
+    return latencies
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions API with injected latency")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--model", action="append", metavar="NAME=SECONDS", help="Median seconds to the first chunk")
+    parser.add_argument("--default-latency", type=float, default=1.0)
+    parser.add_argument("--slow", type=float, default=0.0, help="Share of requests that are slow")
+    parser.add_argument("--slow-factor", type=float, default=4.0)
+    parser.add_argument("--errors", type=float, default=0.0, help="Share of requests that fail")
+    parser.add_argument("--failing", action="append", default=[], metavar="NAME", help="Model whose requests all fail")
+    args = parser.parse_args()
+    app = create_app(
+        parse_latencies(args.model), args.default_latency, args.slow, args.slow_factor, args.errors,
+        failing=set(args.failing),
+    )
+    uvicorn.run(app, port=args.port)
@@ -0,0 +1,166 @@
+"""
+Measures the peak memory of charting a large query result.
+
+    python scripts/profile_memory.py --rows 10000000 --batch-sizes 8192 65536
+
+Writes synthetic crypto data with --rows rows, and a quarter of that, to a
+temporary database. Then it runs a line chart task, a bar chart task and a plan
+of four tasks over each table, every run in a fresh process. Each run fetches
+the whole result first, as the tasks used to, and then streams it in record
+batches of each size. In the plan, two tasks read the whole table and two read
+a few rows they share a filter for, which are fused into one query (see
+fusion.py). Prints the peak resident memory above the process baseline, and
+exits with an error if the streaming peak grows with the number of rows. DuckDB
+and Arrow take a fixed amount on the first query whatever its size, which is why
+the peaks are compared between the two sizes.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+from timeit import default_timer as timer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Every row passes the filter, which tasks share in a plan but is too broad to fuse them on
+LINE = {
+    "query": 'SELECT "symbol", "date", "close" AS "value" FROM {table} WHERE "symbol" <> \'\'',
+    "type": "LINE_CHART",
+    "title": "Closing price",
+    "parameters": {},
+}
+BAR = {
+    # One bar per symbol and year, from every daily row
+    "query": 'SELECT "symbol", date_trunc(\'year\', "date") AS "date", "volume" AS "value" FROM {table} '
+             'WHERE "symbol" <> \'\'',
+    "type": "BAR_CHART",
+    "title": "Yearly volume",
+    "parameters": {"bar_mode": "stack"},
+}
+# Two years of one symbol, few enough rows for the two tasks to be fused
+RECENT = '"symbol" = \'S1\' AND "date" < DATE \'1972-01-01\''
+PLANS = {
+    "line": [LINE],
+    "bar": [BAR],
+    "plan": [
+        LINE,
+        BAR,
+        {**LINE, "query": f'SELECT "symbol", "date", "close" AS "value" FROM {{table}} WHERE {RECENT}'},
+        {**BAR, "query": f'SELECT "symbol", "date", "volume" AS "value" FROM {{table}} WHERE {RECENT}'},
+    ],
+}
+
+
+def reset_peak():
+    # Linux resets the peak resident size (VmHWM) to the current one on "5"
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")
+
+
+def peak_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def build(db_path, tables):
+    import duckdb
+
+    symbols = 10
+    with duckdb.connect(db_path) as conn:
+        for table, rows in tables.items():
+            conn.execute(f"""
+                CREATE TABLE {table} AS
+                SELECT
+                    DATE '1970-01-01' + CAST(i // {symbols} AS INTEGER) AS date,
+                    100 + random() AS close,
+                    random() * 1e9 AS volume,
+                    'S' || (i % {symbols}) AS symbol
+                FROM range({rows}) AS t(i)
+                ORDER BY symbol, date
+            """)
+
+
+def load_plan(name, table):
+    from plan import VisualizationPlan
+
+    return VisualizationPlan.model_validate(
+        {"plan": [{**task, "query": task["query"].format(table=table)} for task in PLANS[name]]}
+    )
+
+
+def run(db_path, name, table, mode):
+    """Runs one plan in this process and prints its peak memory above the baseline."""
+    from cancellation import CancelToken
+    from db import ConnectionPool, get_table_columns
+    from visualization import to_columns
+
+    plan = load_plan(name, table)
+    pool = ConnectionPool(db_path, size=1)
+    table_columns = {table: get_table_columns(pool.conn, table)}
+    baseline = rss_mb()
+    reset_peak()
+    start = timer()
+    if mode == "fetchall":
+        figures = []
+        for task in plan.plan:
+            with pool.cursor() as cursor:
+                data = to_columns(cursor.execute(task.query).fetchnumpy())
+            figures.append(task.run(pool, CancelToken(None), data=data))
+    else:
+        figures = [figure for _, figure in plan.run(pool, table_columns, CancelToken(None))]
+    print(f"{peak_mb() - baseline:.0f} {timer() - start:.2f} {sum(len(figure) for figure in figures)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile peak memory of streaming chart data")
+    parser.add_argument("--rows", type=int, default=10_000_000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8192, 65536])
+    parser.add_argument("--run", nargs=4, metavar=("DB", "PLAN", "TABLE", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        if args.run[3] != "fetchall":
+            # Read by streaming.py when it is imported
+            os.environ["FETCH_BATCH_SIZE"] = args.run[3]
+        run(*args.run)
+        sys.exit()
+
+    tables = {"crypto_full": args.rows, "crypto_quarter": args.rows // 4}
+    modes = ["fetchall"] + [str(size) for size in args.batch_sizes]
+    with tempfile.TemporaryDirectory() as directory:
+        db_path = os.path.join(directory, "memory.duckdb")
+        build(db_path, tables)
+        print(f"{'plan':<6} {'rows':>11} {'mode':<17} {'peak above baseline':>20} {'seconds':>8} {'figure bytes':>13}")
+        failed = False
+        for name in PLANS:
+            peaks = {}
+            for table, rows in tables.items():
+                for mode in modes:
+                    output = subprocess.run(
+                        [sys.executable, __file__, "--run", db_path, name, table, mode],
+                        capture_output=True, text=True, check=True,
+                    ).stdout.split()[-3:]
+                    peak, seconds, size = float(output[0]), float(output[1]), int(output[2])
+                    peaks[table, mode] = peak
+                    label = mode if mode == "fetchall" else f"batches of {mode}"
+                    print(f"{name:<6} {rows:>11,} {label:<17} {peak:>17.0f} MB {seconds:>8.2f} {size:>13,}")
+            # Fetching everything grows with the rows, streaming should barely move
+            fetched = peaks["crypto_full", "fetchall"] - peaks["crypto_quarter", "fetchall"]
+            for mode in modes[1:]:
+                streamed = peaks["crypto_full", mode] - peaks["crypto_quarter", mode]
+                if streamed > max(fetched / 10, 16):
+                    print(f"{name}: batches of {mode} grew by {streamed:.0f} MB with 4x the rows, fetching all by {fetched:.0f} MB")
+                    failed = True
+        sys.exit(1 if failed else 0)
@@ -0,0 +1,159 @@
+"""
+Compares plan generation with routing against always using one model, on the
+local OpenAI stand-in in scripts/mock_openai.py.
+
+    python scripts/profile_routing.py --requests 60 --slow 0.15 --errors 0.05
+
+Starts the stand-in with the given latency per model, then generates a plan for
+each of --requests questions, a mix of simple and complex ones, three times: with
+only the strong model, with only the fast one, and through a ModelRouter. Prints
+the model each routed question got and why, then the time to the first partial
+plan and the failures of each strategy. Exits with an error if routing does not
+lower the 95th percentile of the strong model alone.
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from timeit import default_timer as timer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+QUESTIONS = [
+    "Price of BTC in the last 30D",
+    "Daily volumes for ETH and BTC in March 2024",
+    "30-day volatility of ETH and SOL",
+    "Compare the monthly trading volume of BTC, ETH and SOL in 2023",
+    "Top 5 coins by growth over the last year",
+    "Forecast the BTC price for the next 30 days",
+    "Correlation between BTC and ETH daily returns, per month",
+    "Closing price of SOL",
+]
+
+
+def start_mock(port, args):
+    command = [sys.executable, os.path.join(os.path.dirname(__file__), "mock_openai.py"), "--port", str(port),
+               "--slow", str(args.slow), "--slow-factor", str(args.slow_factor), "--errors", str(args.errors)]
+    for model, seconds in ((args.strong, args.strong_latency), (args.fast, args.fast_latency)):
+        command += ["--model", f"{model}={seconds}"]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while True:
+        try:
+            # Any HTTP answer means the server is up, GET is not routed
+            urllib.request.urlopen(f"http://localhost:{port}/v1/chat/completions", timeout=1)
+        except urllib.error.HTTPError:
+            return server
+        except OSError:
+            if time.time() > deadline:
+                server.terminate()
+                raise RuntimeError("The mock server did not start")
+            time.sleep(0.2)
+
+
+async def generate(router, route, client, token_class):
+    from plan import VisualizationPlan
+
+    start = timer()
+    result = None
+    async for obj in router.generate(route, client, "crypto_data(symbol, date, close)", token_class(route.question)):
+        result = obj
+    VisualizationPlan.model_validate(result.model_dump())
+    return timer() - start
+
+
+async def run_strategy(name, router, models, client, questions, concurrency, verbose):
+    from cancellation import CancelToken
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(question):
+        async with semaphore:
+            route = router.choose(question, *models)
+            try:
+                seconds = await generate(router, route, client, CancelToken)
+            except Exception as e:
+                seconds = None
+                if verbose:
+                    print(f"  {question[:48]:<48} failed: {e}")
+            if verbose and seconds is not None:
+                flags = ", ".join(flag for flag in ("hedged", "fallback") if getattr(route, flag))
+                print(f"  {question[:48]:<48} {route.reason:<32} -> {route.model:<12} "
+                      f"{route.first_partial_seconds:>6.2f}s {flags}")
+            return route, seconds
+
+    results = await asyncio.gather(*(one(question) for question in questions))
+    first = [route.first_partial_seconds for route, seconds in results if route.model]
+    failures = sum(route.model is None for route, _ in results)
+    shares = {}
+    for route, _ in results:
+        if route.model:
+            shares[route.model] = shares.get(route.model, 0) + 1
+    row = (f"{name:<18} {np.percentile(first, 50):>7.2f}s {np.percentile(first, 95):>7.2f}s "
+           f"{max(first):>7.2f}s {failures:>9} {sum(route.hedged for route, _ in results):>7} "
+           f"{sum(route.fallback for route, _ in results):>9}  "
+           + ", ".join(f"{model} {count}" for model, count in shares.items()))
+    return row, np.percentile(first, 95)
+
+
+async def main(args):
+    import instructor
+    from openai import AsyncOpenAI
+
+    from routing import ModelRouter
+
+    # Failed requests are left to the router instead of the client's own retries
+    client = instructor.from_openai(
+        AsyncOpenAI(api_key="mock", base_url=f"http://localhost:{args.port}/v1", max_retries=0)
+    )
+    questions = [QUESTIONS[i % len(QUESTIONS)] for i in range(args.requests)]
+    routed = ModelRouter(hedge_after=args.hedge_after, timeout=args.timeout)
+    strategies = {
+        "routed": (routed, (args.strong, args.fast)),
+        f"{args.strong} only": (ModelRouter(timeout=args.timeout), (args.strong,)),
+        f"{args.fast} only": (ModelRouter(timeout=args.timeout), (args.fast,)),
+    }
+    if args.verbose:
+        print("Routed questions:")
+    rows, p95 = [], {}
+    for name, (router, models) in strategies.items():
+        row, p95[name] = await run_strategy(
+            name, router, models, client, questions, args.concurrency, verbose=args.verbose and name == "routed"
+        )
+        rows.append(row)
+
+    print(f"{'strategy':<18} {'p50':>8} {'p95':>8} {'max':>8} {'failures':>9} {'hedged':>7} {'fallback':>9}  models")
+    print("\n".join(rows))
+    print(f"Router statistics: {routed.summary()}")
+    return p95["routed"] < p95[f"{args.strong} only"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile plan routing against a mock OpenAI API")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--requests", type=int, default=60)
+    parser.add_argument("--concurrency", type=int, default=6)
+    parser.add_argument("--strong", default="gpt-4o")
+    parser.add_argument("--fast", default="gpt-4o-mini")
+    parser.add_argument("--strong-latency", type=float, default=1.5, help="Median seconds to the first chunk")
+    parser.add_argument("--fast-latency", type=float, default=0.4)
+    parser.add_argument("--slow", type=float, default=0.15, help="Share of requests that are slow")
+    parser.add_argument("--slow-factor", type=float, default=5.0)
+    parser.add_argument("--errors", type=float, default=0.05, help="Share of requests that fail")
+    parser.add_argument("--hedge-after", type=float, default=2.0)
+    parser.add_argument("--timeout", type=float, default=8.0)
+    parser.add_argument("--verbose", action=argparse.BooleanOptionalAction, default=True)
+    args = parser.parse_args()
+
+    server = start_mock(args.port, args)
+    try:
+        better = asyncio.run(main(args))
+    finally:
+        server.terminate()
+        server.wait()
+    sys.exit(0 if better else 1)
@@ -0,0 +1,166 @@
+"""
+Profiles how long the apps take to start.
+
+    python scripts/profile_startup.py app.py api.py ../employee-dataviz/app.py
+    python scripts/profile_startup.py --serve
+    python scripts/profile_startup.py --datasets
+
+The first form runs the top-level imports of each file under `python -X importtime`
+and prints the slowest modules. --serve starts the API with uvicorn, with and
+without WARM_UP, and reports the time until /health answers and the latency of
+the first /plan/run request. --datasets starts one API process serving every
+dataset and then one process per dataset, and compares their time until ready and
+resident memory after running a plan on each dataset.
+"""
+import argparse
+import ast
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from timeit import default_timer as timer
+
+
+def top_level_imports(path):
+    tree = ast.parse(open(path).read())
+    return "\n".join(
+        ast.unparse(node) for node in tree.body if isinstance(node, (ast.Import, ast.ImportFrom))
+    )
+
+
+def profile_imports(path, top):
+    directory = os.path.dirname(os.path.abspath(path))
+    start = timer()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", top_level_imports(path)],
+        cwd=directory, capture_output=True, text=True, env={**os.environ, "OPENAI_API_KEY": "profile"},
+    )
+    elapsed = timer() - start
+    if result.returncode != 0:
+        print(f"{path}: imports failed\n{result.stderr.strip().splitlines()[-1]}")
+        return
+
+    # Lines look like: "import time:   self [us] |  cumulative | imported package"
+    modules = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        # Only modules imported directly by the file, their cumulative time includes everything below them
+        if not name.startswith("  "):
+            modules.append((int(cumulative_us), name.strip()))
+
+    print(f"{path}: imports took {round(elapsed, 2)} seconds (including interpreter start)")
+    for cumulative_us, name in sorted(modules, reverse=True)[:top]:
+        print(f"    {name:<30} {cumulative_us / 1e6:.3f}s")
+
+
+def wait_until_ready(url, timeout=60):
+    start = timer()
+    while timer() - start < timeout:
+        try:
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.02)
+    raise TimeoutError(url)
+
+
+PLANS = {
+    "crypto": {"plan": [{
+        "query": 'SELECT "symbol", "date", "close" AS "value" FROM crypto_data ORDER BY "date"',
+        "type": "LINE_CHART",
+        "title": "Closing price",
+        "parameters": {"mode": "lines"},
+    }]},
+    "employee": {"plan": [{
+        "query": 'SELECT "department", sum("interaction_count") AS "value" FROM employee_interactions GROUP BY ALL',
+        "type": "PIE_CHART",
+        "title": "Interactions by department",
+        "parameters": {},
+    }]},
+}
+
+
+def run_plan(port, dataset):
+    request = urllib.request.Request(
+        f"http://localhost:{port}/{dataset}/plan/run", data=json.dumps(PLANS[dataset]).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    urllib.request.urlopen(request).read()
+
+
+def rss_mb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def start_api(port, **env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--port", str(port)],
+        env={**os.environ, "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "profile"), **env},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+
+
+def profile_serve(port):
+    for warm_up in ("false", "true"):
+        start = timer()
+        server = start_api(port, WARM_UP=warm_up, DATASETS="crypto")
+        try:
+            wait_until_ready(f"http://localhost:{port}/health")
+            ready = timer() - start
+            first = timer()
+            run_plan(port, "crypto")
+            first = timer() - first
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"WARM_UP={warm_up}: ready after {round(ready, 2)}s, first /plan/run took {round(first, 3)}s")
+
+
+def profile_datasets(port, datasets):
+    layouts = {"one process": [datasets]} | {f"{name} only": [[name]] for name in datasets}
+    separate = {"ready": 0.0, "rss": 0.0}
+    for label, groups in layouts.items():
+        for names in groups:
+            start = timer()
+            server = start_api(port, DATASETS=",".join(names))
+            try:
+                wait_until_ready(f"http://localhost:{port}/health")
+                ready = timer() - start
+                for name in names:
+                    run_plan(port, name)
+                rss = rss_mb(server.pid)
+            finally:
+                server.terminate()
+                server.wait()
+            print(f"{label:<15} ready after {round(ready, 2)}s, {rss:.0f} MB resident")
+            if len(names) == 1:
+                separate["ready"] += ready
+                separate["rss"] += rss
+    print(f"{'separate total':<15} ready after {round(separate['ready'], 2)}s, {separate['rss']:.0f} MB resident")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile app import and startup time")
+    parser.add_argument("files", nargs="*", default=["app.py", "api.py"])
+    parser.add_argument("--top", type=int, default=10, help="Number of modules to show per file")
+    parser.add_argument("--serve", action="store_true", help="Measure API time to ready instead")
+    parser.add_argument("--datasets", action="store_true", help="Compare one process for all datasets with one per dataset")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.serve:
+        profile_serve(args.port)
+    elif args.datasets:
+        profile_datasets(args.port, ["crypto", "employee"])
+    else:
+        for path in args.files:
+            profile_imports(path, args.top)
@@ -0,0 +1,201 @@
+"""
+Reduces query results batch by batch, so charts never hold the full result.
+
+Query results are read as Arrow record batches and fed to a reducer that keeps
+only what the chart will draw: a bounded number of points per line, candles
+merged into wider ones, or running sums per bar or slice. Each reducer holds at
+most one batch plus its output, and `columns()` returns the output in the column
+format the chart functions take.
+"""
+import numpy as np
+from decouple import config
+
+from visualization import extract_chart_data, to_columns
+
+# Rows per record batch read from DuckDB
+FETCH_BATCH_SIZE = config("FETCH_BATCH_SIZE", default=65536, cast=int)
+# Points kept per line or candlestick series, there is no use in drawing more than a screen has pixels
+MAX_POINTS = config("MAX_POINTS", default=2000, cast=int)
+
+
+def read_batches(cursor, batch_size=None):
+    """Yields the result of the executed query on `cursor` as dictionaries of NumPy columns."""
+    reader = cursor.fetch_record_batch(rows_per_batch=batch_size or FETCH_BATCH_SIZE)
+    for batch in reader:
+        yield to_columns({
+            name: column.to_numpy(zero_copy_only=False) for name, column in zip(batch.schema.names, batch.columns)
+        })
+
+
+def _concat(first, second):
+    return second if first is None else np.concatenate([first, second])
+
+
+def _buckets(length, max_points):
+    # Bucket start positions for reducing `length` points to at most max_points
+    size = -(-length // max(max_points, 1))
+    return np.arange(0, length, size)
+
+
+def _min_max(x, y, max_points):
+    """
+    Keeps the first minimum and maximum of every bucket, in their original order,
+    so spikes survive the reduction. Returns at most max_points points.
+    """
+    starts = _buckets(len(y), max(max_points // 2, 1))
+    size = starts[1] - starts[0] if len(starts) > 1 else len(y)
+    padded = np.full(len(starts) * size, np.nan)
+    padded[:len(y)] = y
+    padded = padded.reshape(len(starts), size)
+    # NaN never wins, a bucket of only NaN keeps its first point
+    low = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    high = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    keep = np.unique(np.concatenate([starts + low, starts + high]))
+    keep = keep[keep < len(y)]
+    return x[keep], y[keep]
+
+
+class Collector:
+    """Keeps every row, for charts that need all of them like forecasts and network graphs."""
+
+    def __init__(self):
+        self._columns = None
+
+    def add(self, columns):
+        if self._columns is None:
+            self._columns = dict(columns)
+        else:
+            self._columns = {name: _concat(values, columns[name]) for name, values in self._columns.items()}
+
+    def columns(self):
+        return self._columns or {}
+
+
+class LineDownsampler:
+    """
+    Keeps at most about `max_points` points per series. Whenever a series grows
+    past twice that, it is reduced to the minimum and maximum of each stretch of
+    points, so repeated reductions keep the extremes of the whole series.
+    """
+
+    def __init__(self, x_field, y_field, group_field, max_points=None):
+        self.x_field, self.y_field, self.group_field = x_field, y_field, group_field
+        self.max_points = max_points or MAX_POINTS
+        self._series = {}
+
+    def add(self, columns):
+        chart_data = extract_chart_data(columns, self.x_field, self.y_field, self.group_field)
+        for group, values in (chart_data.items() if self.group_field else [(None, chart_data)]):
+            x, y = self._series.get(group, (None, None))
+            x, y = _concat(x, values["x"]), _concat(y, values["y"].astype(np.float64))
+            if len(y) > 2 * self.max_points:
+                x, y = _min_max(x, y, self.max_points)
+            self._series[group] = (x, y)
+
+    def columns(self):
+        if not self._series:
+            return {}
+        columns = {
+            self.x_field: np.concatenate([x for x, _ in self._series.values()]),
+            self.y_field: np.concatenate([y for _, y in self._series.values()]),
+        }
+        if self.group_field:
+            columns[self.group_field] = np.concatenate(
+                [np.full(len(y), group, dtype=object) for group, (_, y) in self._series.items()]
+            )
+        return columns
+
+
+class OhlcDownsampler:
+    """
+    Keeps at most about `max_points` candles per series by merging neighbouring
+    candles: the first open, highest high, lowest low and last close.
+    """
+
+    FIELDS = ("open", "high", "low", "close")
+
+    def __init__(self, x_field, group_field, max_points=None):
+        self.x_field, self.group_field = x_field, group_field
+        self.max_points = max_points or MAX_POINTS
+        self._series = {}
+
+    def _merge(self, candles):
+        starts = _buckets(len(candles[self.x_field]), self.max_points)
+        ends = np.r_[starts[1:], len(candles[self.x_field])] - 1
+        return {
+            self.x_field: candles[self.x_field][starts],
+            "open": candles["open"][starts],
+            "high": np.fmax.reduceat(candles["high"], starts),
+            "low": np.fmin.reduceat(candles["low"], starts),
+            "close": candles["close"][ends],
+        }
+
+    def add(self, columns):
+        num_rows = len(next(iter(columns.values()))) if columns else 0
+        fields = {
+            self.x_field: columns.get(self.x_field, np.full(num_rows, "Unknown", dtype=object)),
+            **{field: columns.get(field, np.full(num_rows, np.nan)).astype(np.float64) for field in self.FIELDS},
+        }
+        if self.group_field:
+            groups = columns.get(self.group_field, np.full(num_rows, "Unknown", dtype=object)).astype(str)
+            batches = {group: groups == group for group in dict.fromkeys(groups.tolist())}
+        else:
+            batches = {None: slice(None)}
+        for group, mask in batches.items():
+            candles = {name: values[mask] for name, values in fields.items()}
+            if group in self._series:
+                candles = {name: _concat(values, candles[name]) for name, values in self._series[group].items()}
+            if len(candles[self.x_field]) > 2 * self.max_points:
+                candles = self._merge(candles)
+            self._series[group] = candles
+
+    def columns(self):
+        if not self._series:
+            return {}
+        names = (self.x_field,) + self.FIELDS
+        columns = {name: np.concatenate([candles[name] for candles in self._series.values()]) for name in names}
+        if self.group_field:
+            columns[self.group_field] = np.concatenate(
+                [np.full(len(candles["open"]), group, dtype=object) for group, candles in self._series.items()]
+            )
+        return columns
+
+
+class SumAggregator:
+    """
+    Sums `value_field` per distinct combination of `key_fields`, keeping the
+    keys in the order they first appear. Plotly draws repeated pie labels as
+    their sum and stacks repeated bars, so the chart looks the same.
+    """
+
+    def __init__(self, key_fields, value_field):
+        self.key_fields = [field for field in key_fields if field]
+        self.value_field = value_field
+        self._sums = {}
+
+    def add(self, columns):
+        num_rows = len(next(iter(columns.values()))) if columns else 0
+        if not num_rows:
+            return
+        keys = [columns.get(field, np.full(num_rows, "Unknown", dtype=object)) for field in self.key_fields]
+        values = np.nan_to_num(columns.get(self.value_field, np.zeros(num_rows)).astype(np.float64))
+
+        # Aggregate the batch with NumPy first, so the dictionary only sees each key once per batch
+        codes = np.zeros(num_rows, dtype=np.int64)
+        for key in keys:
+            _, inverse = np.unique(key.astype(str) if key.dtype == object else key, return_inverse=True)
+            codes = codes * (inverse.max() + 1) + inverse
+        unique_codes, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+        sums = np.bincount(inverse, weights=values, minlength=len(unique_codes))
+        for position in np.argsort(first):
+            row = first[position]
+            key = tuple(key[row] for key in keys)
+            self._sums[key] = self._sums.get(key, 0.0) + sums[position]
+
+    def columns(self):
+        if not self._sums:
+            return {}
+        keys = list(self._sums)
+        columns = {field: to_columns({field: [key[i] for key in keys]})[field] for i, field in enumerate(self.key_fields)}
+        columns[self.value_field] = np.array(list(self._sums.values()))
+        return columns
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The app's modules and the scripts are run from their directories, not installed
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "scripts")]
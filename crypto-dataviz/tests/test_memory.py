@@ -0,0 +1,34 @@
+"""
+Peak memory of running plans over large tables, see scripts/profile_memory.py.
+Takes about half a minute.
+"""
+import os
+import subprocess
+import sys
+
+from cancellation import CancelToken
+from db import ConnectionPool, get_table_columns
+from profile_memory import build, load_plan
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scripts", "profile_memory.py")
+
+
+def test_plan_fuses_only_the_narrow_tasks(tmp_path):
+    db_path = str(tmp_path / "plan.duckdb")
+    build(db_path, {"crypto_full": 400_000})
+    pool = ConnectionPool(db_path, size=1)
+    try:
+        plan = load_plan("plan", "crypto_full")
+        table_columns = {"crypto_full": get_table_columns(pool.conn, "crypto_full")}
+        # The two tasks over the whole table share a filter too, but it keeps more rows than a batch
+        assert set(plan._execute_fused(pool, table_columns, CancelToken(None))) == {2, 3}
+    finally:
+        pool.close()
+
+
+def test_streamed_peak_does_not_grow_with_rows():
+    # Runs the single tasks and the plan over 2M and 500k rows, and fails if streaming grows
+    result = subprocess.run(
+        [sys.executable, SCRIPT, "--rows", "2000000", "--batch-sizes", "65536"], capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stdout + result.stderr
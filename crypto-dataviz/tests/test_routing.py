@@ -0,0 +1,172 @@
+"""
+Plan routing against the OpenAI stand-in of scripts/mock_openai.py, served by
+uvicorn on a local port.
+"""
+import asyncio
+import json
+import socket
+import threading
+import time
+from dataclasses import replace
+
+import instructor
+import pytest
+import uvicorn
+from openai import AsyncOpenAI
+from starlette.testclient import TestClient
+
+import api
+from cancellation import CancelToken
+from datasets import DATASETS
+from mock_openai import PLAN, create_app
+from routing import ModelRouter
+
+STRONG = "strong"
+FAST = "fast"
+# Short enough for the fast model
+QUESTION = "Price of BTC"
+TABLE_INFO = "crypto_data(symbol, date, close)"
+
+
+@pytest.fixture
+def serve():
+    """Serves an app in a thread and returns its OpenAI base URL."""
+    servers = []
+
+    def serve(app):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        server = uvicorn.Server(uvicorn.Config(app, log_level="warning"))
+        thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        while not server.started:
+            time.sleep(0.01)
+        return f"http://127.0.0.1:{sock.getsockname()[1]}/v1"
+
+    yield serve
+    for server, thread in servers:
+        server.should_exit = True
+        thread.join()
+
+
+def client(base_url):
+    return instructor.from_openai(AsyncOpenAI(api_key="mock", base_url=base_url, max_retries=0))
+
+
+def generate(router, route, base_url, cancel_after=None):
+    """Returns the partial plans the router streams for `route`."""
+    async def partials():
+        token = CancelToken(route.question)
+        if cancel_after is not None:
+            asyncio.get_running_loop().call_later(cancel_after, token.cancel)
+        return [plan async for plan in router.generate(route, client(base_url), TABLE_INFO, token)]
+
+    return asyncio.run(partials())
+
+
+def is_mock_plan(plan):
+    # The partial plan also has the fields the stand-in leaves out, as None
+    return [task["query"] for task in plan["plan"]] == [task["query"] for task in PLAN["plan"]]
+
+
+def wait_for(condition, timeout=2.0):
+    # The server notices a closed connection a little after the client closes it
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_hedges_after_the_deadline(serve):
+    app = create_app({FAST: 3.0, STRONG: 0.1}, seed=0)
+    base_url = serve(app)
+    router = ModelRouter(hedge_after=0.3, timeout=10)
+    route = router.choose(QUESTION, STRONG, FAST)
+    assert route.primary == FAST
+
+    partials = generate(router, route, base_url)
+
+    assert is_mock_plan(partials[-1].model_dump(mode="json"))
+    assert route.model == STRONG and route.hedged and not route.fallback
+    assert 0.3 <= route.first_partial_seconds < 2
+    assert app.state.requests == {FAST: 1, STRONG: 1}
+    # The fast model's stream was closed once the strong one won
+    assert wait_for(lambda: app.state.closed_early[FAST] == 1)
+    assert app.state.closed_early[STRONG] == 0
+    # Its time so far is not a latency, nor a failure
+    assert not router.stats[FAST].latencies and not router.stats[FAST].failures
+    assert len(router.stats[FAST].censored) == 1
+    assert len(router.stats[STRONG].latencies) == 1
+
+
+def test_falls_back_on_an_error(serve):
+    app = create_app({FAST: 0.1, STRONG: 0.1}, seed=0, failing={FAST})
+    base_url = serve(app)
+    router = ModelRouter(hedge_after=10, timeout=10)
+    route = router.choose(QUESTION, STRONG, FAST)
+
+    partials = generate(router, route, base_url)
+
+    assert is_mock_plan(partials[-1].model_dump(mode="json"))
+    assert route.model == STRONG and route.fallback and not route.hedged
+    assert list(router.stats[FAST].failures) == [True]
+    assert list(router.stats[STRONG].failures) == [False]
+
+
+def test_falls_back_on_a_timeout(serve):
+    app = create_app({FAST: 5.0, STRONG: 0.1}, seed=0)
+    base_url = serve(app)
+    # The hedge deadline is capped at the timeout, so the fast model times out before a hedge
+    router = ModelRouter(hedge_after=10, timeout=0.5)
+    route = router.choose(QUESTION, STRONG, FAST)
+
+    partials = generate(router, route, base_url)
+
+    assert is_mock_plan(partials[-1].model_dump(mode="json"))
+    assert route.model == STRONG and route.fallback and not route.hedged
+    assert 0.5 <= route.first_partial_seconds < 3
+    assert list(router.stats[FAST].failures) == [True]
+    assert wait_for(lambda: app.state.closed_early[FAST] == 1)
+
+
+def test_cancelled_request_is_not_a_latency(serve):
+    app = create_app({FAST: 3.0}, seed=0)
+    base_url = serve(app)
+    router = ModelRouter(hedge_after=10, timeout=10)
+    route = router.choose(QUESTION, STRONG, FAST)
+
+    assert generate(router, route, base_url, cancel_after=0.2) == []
+    assert route.model is None
+    assert not router.stats[FAST].latencies and not router.stats[FAST].failures
+    assert router.summary()[FAST]["stopped"] == 1
+    assert wait_for(lambda: app.state.closed_early[FAST] == 1)
+
+
+def test_route_in_plan_response_headers(serve, monkeypatch):
+    app = create_app({FAST: 3.0, STRONG: 0.1}, seed=0)
+    base_url = serve(app)
+    monkeypatch.setattr(api, "router", ModelRouter(hedge_after=0.3, timeout=10))
+    monkeypatch.setitem(api.clients, "openai", client(base_url))
+    monkeypatch.setitem(api.datasets, "crypto", {
+        "dataset": replace(DATASETS["crypto"], model=STRONG, fast_model=FAST),
+        "table_info": TABLE_INFO,
+        "system_message": None,
+    })
+
+    # Without the context manager, the app's lifespan does not open the real datasets
+    response = TestClient(api.app).post("/crypto/plan", json={"question": QUESTION})
+
+    assert response.status_code == 200
+    assert response.headers["X-Plan-Model"] == STRONG
+    route = json.loads(response.headers["X-Plan-Route"])
+    assert route["primary"] == FAST and route["secondary"] == STRONG
+    assert route["model"] == STRONG and route["hedged"] and not route["fallback"]
+    assert is_mock_plan(json.loads(response.text.splitlines()[-1]))
+
+
+def test_single_model_dataset_is_not_routed():
+    employee = DATASETS["employee"]
+    for question in (QUESTION, "Compare the interaction trends between each pair of departments"):
+        route = ModelRouter().choose(question, employee.model, employee.fast_model)
+        assert route.primary == employee.model and route.secondary is None
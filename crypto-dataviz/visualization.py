@@ -1,39 +1,111 @@
+import base64
+import datetime
+import hashlib
+import json
+import numbers
+import threading
+from collections import OrderedDict
+import numpy as np
 import plotly.graph_objects as go
+import plotly.io as pio
+from plotly.colors import hex_to_rgb, qualitative
+from plotly.utils import PlotlyJSONEncoder
 
-def extract_chart_data(data, x_field, y_field, group_field=None):
+# Serialized figures keyed by the task and a hash of its data, see cached_figure_json
+FIGURE_CACHE_SIZE = 256
+_figure_cache = OrderedDict()
+_figure_cache_lock = threading.Lock()
+
+# Trace fields that are sent as base64 typed arrays instead of JSON lists
+TYPED_ARRAY_FIELDS = ("x", "y", "values", "open", "high", "low", "close")
+
+def _as_array(values):
+    if isinstance(values, np.ma.MaskedArray):
+        # fetchnumpy masks NULLs
+        if values.dtype.kind in "iuf":
+            return values.astype(np.float64).filled(np.nan)
+        if values.dtype.kind == "M":
+            return values.filled(np.datetime64("NaT"))
+        return values.astype(object).filled(None)
+    array = np.asarray(values)
+    if array.dtype != object or not len(array):
+        return array
+    # DuckDB returns dates and decimals as Python objects
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime.date):
+        return np.array(values, dtype="datetime64[ms]")
+    if isinstance(sample, numbers.Number):
+        return np.array([np.nan if value is None else float(value) for value in values])
+    return array
+
+def to_columns(data):
+    """
+    Converts query results to a dictionary of NumPy arrays, one per column.
+
+    Parameters:
+    - data: List of dictionaries representing the data points, or a dictionary of column values.
+    """
+    if isinstance(data, dict):
+        return {name: _as_array(values) for name, values in data.items()}
+    names = list(data[0]) if data else []
+    return {name: _as_array([entry.get(name) for entry in data]) for name in names}
+
+def _column(columns, field, default):
+    if field in columns:
+        return columns[field]
+    num_rows = len(next(iter(columns.values()))) if columns else 0
+    return np.full(num_rows, default, dtype=object if isinstance(default, str) else float)
+
+def _axis_values(values):
+    # Dates go out as epoch milliseconds, which date axes understand and which pack into a typed array
+    if values.dtype.kind == "M":
+        return values.astype("datetime64[ms]").astype(np.int64).astype(np.float64)
+    return values
+
+def _axis_type(values):
+    return "date" if values.dtype.kind == "M" else None
+
+def extract_chart_data(columns, x_field, y_field, group_field=None):
     """
     Extracts and organizes data for chart plotting.
 
     Parameters:
-    - data: List of dictionaries representing the data points.
+    - columns: Dictionary of NumPy arrays, as returned by to_columns.
     - x_field: The field to be used for x-axis values.
     - y_field: The field to be used for y-axis values.
     - group_field: Optional field for grouping data (used in bar charts).
 
     Returns:
-    - If group_field is provided: Dictionary with groups as keys and (x, y) pairs as values.
-    - If group_field is not provided: Tuple of (x_values, y_values).
+    - If group_field is provided: Dictionary with groups as keys and (x, y) arrays as values.
+    - If group_field is not provided: Dictionary of x and y arrays.
     """
-    grouped_data = {}
-    if group_field:
-        for entry in data:
-            group = entry.get(group_field, "Unknown")
-            x_value = entry.get(x_field, "Unknown")
-            y_value = entry.get(y_field, 0)
-            if group not in grouped_data:
-                grouped_data[group] = {"x": [], "y": []}
-            grouped_data[group]["x"].append(x_value)
-            grouped_data[group]["y"].append(y_value)
-        return grouped_data
-    else:
-        x_values = [entry.get(x_field, "Unknown") for entry in data]
-        y_values = [entry.get(y_field, 0) for entry in data]
+    x_values = _column(columns, x_field, "Unknown")
+    y_values = _column(columns, y_field, 0)
+    if not group_field:
         return {"x": x_values, "y": y_values}
 
+    groups = _column(columns, group_field, "Unknown").astype(str)
+    names, first_index, inverse = np.unique(groups, return_index=True, return_inverse=True)
+    grouped_data = {}
+    # Groups keep the order in which they first appear in the data
+    for group in np.argsort(first_index):
+        mask = inverse == group
+        grouped_data[str(names[group])] = {"x": x_values[mask], "y": y_values[mask]}
+    return grouped_data
+
+def _series(columns, x_field, y_field, group_field):
+    # One series per group, or a single unnamed series without a group field
+    chart_data = extract_chart_data(columns, x_field, y_field, group_field)
+    return chart_data if group_field else {None: chart_data}
+
+def _label(field):
+    return field.replace("_", " ").capitalize() if field else None
+
 def get_bar_chart(data, title, x_field="date", y_field="value", group_field="symbol", barmode="group"):
-    grouped_data = extract_chart_data(data, x_field, y_field, group_field)
+    columns = to_columns(data)
+    grouped_data = _series(columns, x_field, y_field, group_field)
     traces = [
-        go.Bar(name=group, x=values["x"], y=values["y"], offsetgroup=idx)
+        go.Bar(name=group, x=_axis_values(values["x"]), y=values["y"], offsetgroup=idx)
         for idx, (group, values) in enumerate(grouped_data.items())
     ]
 
@@ -41,30 +113,261 @@ def get_bar_chart(data, title, x_field="date", y_field="value", group_field="sym
     fig.update_layout(
         barmode=barmode,
         title=title,
-        xaxis_title=x_field.capitalize(),
-        yaxis_title=y_field.capitalize(),
-        legend_title=group_field.capitalize(),
+        xaxis_title=_label(x_field),
+        xaxis_type=_axis_type(_column(columns, x_field, "Unknown")),
+        yaxis_title=_label(y_field),
+        legend_title=_label(group_field),
     )
     return fig
 
 def get_pie_chart(data, title, value_field="value", name_field="symbol"):
-    chart_data = extract_chart_data(data, name_field, value_field)
+    chart_data = extract_chart_data(to_columns(data), name_field, value_field)
     fig = go.Figure(data=[go.Pie(labels=chart_data["x"], values=chart_data["y"], hole=0.4)])
     fig.update_layout(title_text=title)
     return fig
 
-def get_line_chart(data, title, x_field="date", y_field="value", group_field="symbol"):
-    grouped_data = extract_chart_data(data, x_field, y_field, group_field)
-    traces = [
-        go.Scatter(name=group, x=values["x"], y=values["y"], mode='lines')
-        for group, values in grouped_data.items()
+def warm_up():
+    """
+    Builds one small chart of each type. Plotly loads its trace classes on first
+    use, which otherwise makes the first chart request noticeably slower.
+    """
+    sample = [{"date": datetime.date(2024, 1, 1), "value": 1.0, "symbol": "BTC"}]
+    ohlc = [{**sample[0], "open": 1.0, "high": 1.0, "low": 1.0, "close": 1.0}]
+    charts = (get_bar_chart(sample, ""), get_pie_chart(sample, ""), get_line_chart(sample, ""), get_candlestick_chart(ohlc, ""))
+    for fig in charts:
+        figure_to_json(fig)
+
+def _forecast_traces(group, forecast, color):
+    red, green, blue = hex_to_rgb(color)
+    x_values = _axis_values(forecast["x"])
+    return [
+        # The prediction interval as one closed shape, upper bound forward and lower bound back
+        go.Scatter(
+            x=np.concatenate([x_values, x_values[::-1]]),
+            y=np.concatenate([forecast["upper"], forecast["lower"][::-1]]),
+            fill="toself",
+            fillcolor=f"rgba({red}, {green}, {blue}, 0.2)",
+            line=dict(width=0),
+            hoverinfo="skip",
+            legendgroup=group,
+            showlegend=False,
+        ),
+        go.Scatter(
+            name=f"{group} forecast" if group else "Forecast",
+            x=x_values,
+            y=forecast["mean"],
+            mode="lines",
+            line=dict(color=color, dash="dash"),
+            legendgroup=group,
+        ),
     ]
 
+def get_line_chart(data, title, x_field="date", y_field="value", group_field="symbol", forecast=None):
+    """
+    Line chart with one line per group. `forecast` holds forecasts per group, as
+    returned by forecast.forecast_series, drawn as dashed lines with their
+    prediction intervals after the history.
+    """
+    columns = to_columns(data)
+    grouped_data = _series(columns, x_field, y_field, group_field)
+    traces = []
+    for idx, (group, values) in enumerate(grouped_data.items()):
+        if not forecast:
+            traces.append(go.Scatter(name=group, x=_axis_values(values["x"]), y=values["y"], mode='lines'))
+            continue
+        # The forecast of a series shares its color and legend entry
+        color = qualitative.Plotly[idx % len(qualitative.Plotly)]
+        traces.append(go.Scatter(
+            name=group, x=_axis_values(values["x"]), y=values["y"], mode='lines', line=dict(color=color), legendgroup=group
+        ))
+        if group in forecast:
+            traces.extend(_forecast_traces(group, forecast[group], color))
+
     fig = go.Figure(data=traces)
     fig.update_layout(
         title=title,
-        xaxis_title=x_field.capitalize(),
-        yaxis_title=y_field.capitalize(),
-        legend_title=group_field.capitalize(),
+        xaxis_title=_label(x_field),
+        xaxis_type=_axis_type(_column(columns, x_field, "Unknown")),
+        yaxis_title=_label(y_field),
+        legend_title=_label(group_field),
     )
     return fig
+
+def get_candlestick_chart(data, title, x_field="date", group_field="symbol"):
+    """One candlestick trace per group from the "open", "high", "low" and "close" columns."""
+    columns = to_columns(data)
+    x_values = _column(columns, x_field, "Unknown")
+    masks = {None: slice(None)}
+    if group_field:
+        groups = _column(columns, group_field, "Unknown").astype(str)
+        # Groups keep the order in which they first appear in the data
+        masks = {group: groups == group for group in dict.fromkeys(groups.tolist())}
+    traces = []
+    for group, mask in masks.items():
+        traces.append(go.Candlestick(
+            name=group,
+            x=_axis_values(x_values[mask]),
+            **{field: _column(columns, field, np.nan)[mask] for field in ("open", "high", "low", "close")},
+        ))
+
+    fig = go.Figure(data=traces)
+    fig.update_layout(
+        title=title,
+        xaxis_title=_label(x_field),
+        xaxis_type=_axis_type(x_values),
+        # The range slider draws every candle a second time
+        xaxis_rangeslider_visible=False,
+        yaxis_title="Price",
+        legend_title=_label(group_field),
+    )
+    return fig
+
+def get_network_graph(data, title, source_field="source", target_field="target", edge_field="value", graph_type="undirected"):
+    # networkx is slow to import and only needed for network graphs, so load it on first use
+    import networkx as nx
+
+    columns = to_columns(data)
+    G = nx.DiGraph() if graph_type == "directed" else nx.Graph()
+
+    node_pairs = set()  # To ensure unique node pairs
+    edge_weights = _column(columns, edge_field, 1)
+    for source_node, target_node, edge_weight in zip(columns[source_field], columns[target_field], edge_weights):
+        if (source_node, target_node) not in node_pairs and (target_node, source_node) not in node_pairs:
+            G.add_edge(source_node, target_node, weight=edge_weight)
+            node_pairs.add((source_node, target_node))
+
+    pos = nx.spring_layout(G)
+    edge_x = []
+    edge_y = []
+    for source_node, target_node in G.edges():
+        x0, y0 = pos[source_node]
+        x1, y1 = pos[target_node]
+        edge_x += [x0, x1, None]
+        edge_y += [y0, y1, None]
+
+    edge_trace = go.Scatter(
+        x=edge_x,
+        y=edge_y,
+        line=dict(width=0.5, color="#888"),
+        hoverinfo="none",
+        mode="lines",
+    )
+
+    nodes = list(G.nodes())
+    node_trace = go.Scatter(
+        x=np.array([pos[node][0] for node in nodes]),
+        y=np.array([pos[node][1] for node in nodes]),
+        text=[str(node) for node in nodes],
+        mode="markers",
+        hoverinfo="text",
+        marker=dict(
+            showscale=True,
+            colorscale="YlGnBu",
+            size=10,
+            color=np.array([len(list(G.neighbors(node))) for node in nodes]),
+            colorbar=dict(
+                thickness=15,
+                title="Node Connections",
+                xanchor="left",
+                titleside="right",
+            ),
+        ),
+    )
+
+    fig = go.Figure(
+        data=[edge_trace, node_trace],
+        layout=go.Layout(
+            title=title,
+            showlegend=False,
+            hovermode="closest",
+            margin=dict(b=20, l=5, r=5, t=40),
+            annotations=[dict(text="Network Graph", showarrow=False, xref="paper", yref="paper")],
+            xaxis=dict(showgrid=False, zeroline=False),
+            yaxis=dict(showgrid=False, zeroline=False),
+        ),
+    )
+    return fig
+
+def _typed_array(values):
+    # plotly.js typed arrays have no 64-bit integer type, so wide integers go as doubles
+    if values.dtype.kind in "iu" and len(values) and values.min() >= -2**31 and values.max() < 2**31:
+        dtype, values = "i4", values.astype("<i4")
+    elif values.dtype.kind in "iuf":
+        dtype, values = "f8", values.astype("<f8")
+    else:
+        return None
+    return {"dtype": dtype, "bdata": base64.b64encode(values.tobytes()).decode("ascii")}
+
+def _uniform_step(values):
+    if len(values) < 3 or values.dtype.kind not in "iuf":
+        return None
+    steps = np.diff(values)
+    if steps[0] != 0 and np.isfinite(steps[0]) and np.all(steps == steps[0]):
+        return steps[0].item()
+    return None
+
+def figure_to_json(fig):
+    """
+    Serializes a figure with its numeric arrays encoded as base64 typed arrays.
+    Evenly spaced x values, like a daily series, are replaced by x0 and dx.
+    """
+    figure = fig.to_plotly_json()
+    # The charts only use the default template, which plotly.py re-applies when
+    # the figure is loaded and Streamlit replaces with its theme anyway. It is
+    # about 7.5 KB, files read by other tools get it back from with_template.
+    figure["layout"].pop("template", None)
+    for trace in figure["data"]:
+        x_values = trace.get("x")
+        if isinstance(x_values, np.ndarray) and trace.get("type") in ("scatter", "bar"):
+            step = _uniform_step(x_values)
+            if step is not None:
+                del trace["x"]
+                trace["x0"], trace["dx"] = x_values[0].item(), step
+        for field in TYPED_ARRAY_FIELDS:
+            values = trace.get(field)
+            if isinstance(values, np.ndarray):
+                encoded = _typed_array(values)
+                if encoded is not None:
+                    trace[field] = encoded
+    return json.dumps(figure, cls=PlotlyJSONEncoder)
+
+def with_template(figure_json):
+    """
+    Adds the default template that figure_to_json leaves out back to a serialized
+    figure, so it looks the same wherever it is loaded, like batch.py's files.
+    """
+    figure = json.loads(figure_json)
+    figure["layout"].setdefault("template", pio.templates[pio.templates.default].to_plotly_json())
+    return json.dumps(figure)
+
+def decode_typed_arrays(figure):
+    """
+    Turns the typed arrays of a figure dictionary back into NumPy arrays, for
+    Plotly versions that do not accept them as figure input.
+    """
+    for trace in figure.get("data", []):
+        for field, values in trace.items():
+            if isinstance(values, dict) and "bdata" in values:
+                trace[field] = np.frombuffer(base64.b64decode(values["bdata"]), dtype="<" + values["dtype"])
+    return figure
+
+def data_hash(columns):
+    digest = hashlib.blake2b(digest_size=16)
+    for name, values in columns.items():
+        digest.update(name.encode())
+        digest.update(values.tobytes() if values.dtype != object else repr(values.tolist()).encode())
+    return digest.hexdigest()
+
+def cached_figure_json(key, build_figure):
+    """Returns the serialized figure for `key`, building it with `build_figure` on a miss."""
+    with _figure_cache_lock:
+        if key in _figure_cache:
+            _figure_cache.move_to_end(key)
+            return _figure_cache[key]
+
+    figure_json = figure_to_json(build_figure())
+    with _figure_cache_lock:
+        _figure_cache[key] = figure_json
+        while len(_figure_cache) > FIGURE_CACHE_SIZE:
+            _figure_cache.popitem(last=False)
+    return figure_json
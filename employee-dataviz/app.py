@@ -27,6 +27,13 @@ def init_db():
 
 cur, conn = init_db()
 
+# The schema prompt only depends on the database, so build it once per process
+@st.cache_resource
+def init_table_info():
+    return get_table_info(conn)
+
+table_info = init_table_info()
+
 analysis_system_message = """
 You are a DuckDB and data visualization expert. Given a data visualization request, you return a visualization plan consisting of visualization tasks.
 Each visualization task consists of:
@@ -196,7 +203,7 @@ if len(st.session_state.user_input) > 0:
     user_input = st.session_state.user_input
     with st.spinner("Generating query plan..."):
         start = timer()
-        visualization_plan = asyncio.run(async_generate_visualization_plan(get_table_info(conn), user_input))
+        visualization_plan = asyncio.run(async_generate_visualization_plan(table_info, user_input))
         end = timer()
         st.info(f"Query plan generated in {round(end - start, 2)} seconds")
         print(visualization_plan.model_dump())
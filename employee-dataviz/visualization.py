@@ -1,5 +1,4 @@
 import plotly.graph_objects as go
-import networkx as nx
 
 def extract_chart_data(data, x_field, y_field, group_field=None):
     grouped_data = {}
@@ -71,6 +70,9 @@ def get_line_chart(data, title, x_field="interaction_date", y_field="interaction
     return fig
 
 def get_network_graph(data, title, source_field, target_field, edge_field, graph_type='undirected'):
+    # networkx is slow to import and only needed for network graphs, so load it on first use
+    import networkx as nx
+
     G = nx.DiGraph() if graph_type == 'directed' else nx.Graph()
 
     node_pairs = set()  # To ensure unique node pairs
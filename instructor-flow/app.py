@@ -1,15 +1,10 @@
 import instructor
-from pydantic import BaseModel
 from openai import OpenAI
 from dotenv import load_dotenv
 
-load_dotenv()
-
-# Define your desired output structure
-class UserInfo(BaseModel):
-    name: str
-    age: int
+from models import UserInfo
 
+load_dotenv()
 
 # Patch the OpenAI client
 client = instructor.from_openai(OpenAI())
@@ -0,0 +1,179 @@
+"""
+Content-addressed cache of extractions, stored in SQLite.
+
+Entries are keyed on a hash of the normalized input text, the response model's
+JSON schema and the model name, so the same text is only sent to the model once
+per schema and model. Changing a field of the response model changes its schema:
+the old entries can no longer be hit, and are deleted when the cache is opened
+for the new schema. The file is kept under a size limit by deleting the least
+recently used entries.
+
+Reads take no lock, and hits only update the access times in memory. These are
+written in a short transaction every ACCESS_BATCH hits or ACCESS_SECONDS
+seconds, with the next put, or on close, so that a run of hits does not keep
+other processes from writing to the file. The cache is used from the event loop
+of extract.py, so a write waits at most WRITE_TIMEOUT seconds for another
+process's lock. After that the write fails, and so does every write in the next
+LOCKED_SECONDS, without waiting.
+"""
+import hashlib
+import json
+import sqlite3
+import sys
+import time
+import unicodedata
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extractions (
+    key TEXT PRIMARY KEY,
+    response_model TEXT NOT NULL,
+    schema_hash TEXT NOT NULL,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS extractions_accessed ON extractions (accessed);
+"""
+# Bytes an entry takes besides its value, roughly: the key, the other columns and the index
+ENTRY_OVERHEAD = 150
+# Hits, or seconds since the last write, after which the access times are written
+ACCESS_BATCH = 100
+ACCESS_SECONDS = 5.0
+# Seconds a write waits for another process to release the file, and seconds the
+# writes then fail straight away for
+WRITE_TIMEOUT = 0.1
+LOCKED_SECONDS = 5.0
+
+
+def normalize(text):
+    """
+    Unicode-normalizes the text and collapses whitespace. Case is kept, since the
+    extracted values can depend on it.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def schema_hash(response_model):
+    schema = json.dumps(response_model.model_json_schema(), sort_keys=True)
+    return hashlib.sha256(schema.encode()).hexdigest()
+
+
+class ExtractionCache:
+    """
+    Cached extractions of one response model by one model. Not safe to share
+    between threads, but several processes can use the same file.
+    """
+
+    def __init__(self, path, response_model, model, max_bytes=256 * 2**20):
+        self.response_model = response_model.__name__
+        self.schema_hash = schema_hash(response_model)
+        self.model = model
+        self.max_bytes = max_bytes
+        self.conn = sqlite3.connect(path, timeout=WRITE_TIMEOUT)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        # Access times of the hits since the last write, by key
+        self.accessed = {}
+        self.hits = 0
+        self.written = time.monotonic()
+        self.locked_until = 0.0
+        try:
+            stale = self._write(lambda: self.conn.execute(
+                "DELETE FROM extractions WHERE response_model = ? AND schema_hash != ?",
+                (self.response_model, self.schema_hash),
+            ).rowcount)
+        except sqlite3.OperationalError as e:
+            # They cannot be hit, so they can wait for the next time the cache is opened
+            stale = 0
+            print(f"Could not delete the extractions of older schemas: {e}", file=sys.stderr)
+        if stale:
+            print(f"Deleted {stale} cached {self.response_model} extractions of an older schema")
+        self.size = self.conn.execute("SELECT coalesce(sum(size), 0) FROM extractions").fetchone()[0]
+
+    def key(self, text):
+        return hashlib.sha256(
+            "\0".join((normalize(text), self.schema_hash, self.model)).encode()
+        ).hexdigest()
+
+    def get(self, key):
+        """Returns the cached extraction for `key` as a dictionary, or None."""
+        row = self.conn.execute("SELECT value FROM extractions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.accessed[key] = time.time()
+        self.hits += 1
+        if self.hits >= ACCESS_BATCH or time.monotonic() - self.written >= ACCESS_SECONDS:
+            try:
+                self._write(self._write_accessed)
+            except sqlite3.OperationalError as e:
+                # Another process holds the lock, hits do not need to be durable: try again after the next batch
+                self.hits = 0
+                self.written = time.monotonic()
+                print(f"Could not update the cache's access times: {e}", file=sys.stderr)
+        return json.loads(row[0])
+
+    def put(self, entries):
+        """
+        Stores {key: extraction dictionary} and the pending access times in one
+        transaction, then evicts if over the limit. Raises sqlite3.OperationalError
+        if the file is locked, with nothing stored.
+        """
+        now = time.time()
+        rows = []
+        for key, value in entries.items():
+            value = json.dumps(value)
+            rows.append((key, self.response_model, self.schema_hash, value, len(value) + ENTRY_OVERHEAD, now))
+
+        def store():
+            self._write_accessed()
+            replaced = self.conn.execute(
+                f"SELECT coalesce(sum(size), 0) FROM extractions WHERE key IN ({', '.join('?' * len(rows))})",
+                [row[0] for row in rows],
+            ).fetchone()[0]
+            self.conn.executemany("INSERT OR REPLACE INTO extractions VALUES (?, ?, ?, ?, ?, ?)", rows)
+            size = self.size + sum(row[4] for row in rows) - replaced
+            return self._evict(size) if size > self.max_bytes else size
+
+        self.size = self._write(store)
+
+    def _write_accessed(self):
+        self.conn.executemany(
+            "UPDATE extractions SET accessed = ? WHERE key = ?",
+            [(accessed, key) for key, accessed in self.accessed.items()],
+        )
+
+    def _write(self, write):
+        # Runs `write` in a transaction, committed or rolled back right away so no lock is kept
+        if time.monotonic() < self.locked_until:
+            raise sqlite3.OperationalError(f"database is locked, writes resume in {LOCKED_SECONDS} seconds at most")
+        try:
+            result = write()
+            self.conn.commit()
+        except sqlite3.Error as e:
+            self.conn.rollback()
+            if isinstance(e, sqlite3.OperationalError):
+                self.locked_until = time.monotonic() + LOCKED_SECONDS
+            raise
+        self.accessed.clear()
+        self.hits = 0
+        self.written = time.monotonic()
+        return result
+
+    def _evict(self, size):
+        # Down to 90% of the limit, so eviction does not run again on the next put
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, entry_size in self.conn.execute("SELECT key, size FROM extractions ORDER BY accessed"):
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self.conn.executemany("DELETE FROM extractions WHERE key = ?", evicted)
+        return size
+
+    def close(self):
+        try:
+            self._write(self._write_accessed)
+        except sqlite3.OperationalError as e:
+            print(f"Could not update the cache's access times: {e}", file=sys.stderr)
+        self.conn.close()
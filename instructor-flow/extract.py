@@ -0,0 +1,273 @@
+"""
+Extracts a response model from every line of a text file, concurrently.
+
+    python extract.py input.txt --output output.jsonl --batch-size 10 --concurrency 16
+
+The input is read line by line and several lines go into one request, which asks
+for a list with one numbered item per line. A response that fails validation,
+including one that misses a line or numbers it twice, is sent back to the model
+with the errors, as instructor does for a single object. A batch that still fails
+is retried one line at a time, so one bad line does not fail the others. At most
+--concurrency requests are in flight and only as many lines are read as they need,
+so the input can be larger than memory.
+
+Lines whose normalized text was extracted before with the same response model
+schema and model come from the cache in --cache (see cache.py), and a line whose
+text is already waiting for a request gets that request's result instead of
+being sent again. With the cache each distinct text is sent to the model once.
+Results that cannot be cached, because another process keeps the file locked,
+are still written.
+
+Each output line is {"line": ..., "input": ..., "output": {...}}, or "error"
+instead of "output", and "cached": true for cache hits. Lines are written as
+soon as their result is known, so the output is in completion order. Progress
+and the final throughput are printed to stderr.
+
+Set OPENAI_BASE_URL to run against another endpoint, e.g. mock_openai.py.
+"""
+import argparse
+import asyncio
+import json
+import sqlite3
+import sys
+from functools import lru_cache
+from typing import List
+from timeit import default_timer as timer
+
+import instructor
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from pydantic import Field, ValidationInfo, create_model, model_validator
+from tenacity import AsyncRetrying, stop_after_attempt, wait_exponential
+
+from cache import ExtractionCache, normalize
+from models import UserInfo
+
+load_dotenv()
+
+SYSTEM_MESSAGE = """
+Extract a {name} from each of the numbered texts below.
+Return exactly one item per text, with the number of the text as its index.
+"""
+
+
+def read_lines(path):
+    """Yields (line number, text) for the non-empty lines of `path`, one at a time."""
+    with open(path) as f:
+        for line_number, line in enumerate(f, start=1):
+            text = line.strip()
+            if text:
+                yield line_number, text
+
+
+@lru_cache
+def batch_model(response_model):
+    """
+    A response model for several texts at once: a list of `response_model` items,
+    each with the number of the text it came from. The validation context's
+    "count" is the number of texts, every number has to appear exactly once.
+    """
+    item = create_model(
+        f"Numbered{response_model.__name__}",
+        __base__=response_model,
+        index=(int, Field(description="Number of the text this was extracted from")),
+    )
+
+    def check_indexes(batch, info: ValidationInfo):
+        count = (info.context or {}).get("count")
+        indexes = sorted(extracted.index for extracted in batch.items)
+        if count is not None and indexes != list(range(count)):
+            raise ValueError(f"Expected one item for each text from 0 to {count - 1}, got indexes {indexes}")
+        return batch
+
+    return create_model(
+        f"{response_model.__name__}List",
+        items=(List[item], ...),
+        __validators__={"check_indexes": model_validator(mode="after")(check_indexes)},
+    )
+
+
+class Progress:
+    """Counts what the pipeline did, and prints the rates."""
+
+    def __init__(self):
+        self.start = timer()
+        self.lines = 0
+        self.failed = 0
+        self.requests = 0
+        self.retries = 0
+        self.tokens = 0
+        self.in_flight = 0
+        # Lines answered from the cache, and by the request for an identical line
+        self.cached = 0
+        self.deduplicated = 0
+        # Extracted lines that could not be cached, because the cache file was locked
+        self.uncached = 0
+
+    def report(self, final=False):
+        elapsed = timer() - self.start
+        rate = lambda count: round(count / elapsed, 1) if elapsed else 0
+        status = "Extracted" if final else "Extracting:"
+        print(
+            f"{status} {self.lines} lines in {round(elapsed, 1)} seconds, {rate(self.lines)} lines/second, "
+            f"{rate(self.requests)} requests/second, {rate(self.tokens)} tokens/second, "
+            f"{self.cached} cached, {self.deduplicated} deduplicated, {self.retries} retries, {self.failed} failed"
+            + (f", {self.uncached} not cached" if self.uncached else "")
+            + ("" if final else f", {self.in_flight} requests in flight"),
+            file=sys.stderr,
+        )
+
+
+def retrying(attempts, progress):
+    # A new one per request, tenacity keeps the state of the current attempt in it
+    def count(retry_state):
+        progress.retries += 1
+
+    return AsyncRetrying(
+        stop=stop_after_attempt(attempts),
+        wait=wait_exponential(multiplier=0.5, max=10),
+        before_sleep=count,
+        reraise=True,
+    )
+
+
+async def extract_batch(client, response_model, batch, args, progress):
+    """Returns the extracted object of each (key, text) in `batch`, in order."""
+    messages = [
+        {"role": "system", "content": SYSTEM_MESSAGE.format(name=response_model.__name__)},
+        {"role": "user", "content": "\n".join(f"{index}: {text}" for index, (_, text) in enumerate(batch))},
+    ]
+    progress.in_flight += 1
+    try:
+        result, completion = await client.chat.completions.create_with_completion(
+            model=args.model,
+            response_model=batch_model(response_model),
+            messages=messages,
+            max_retries=retrying(args.retries + 1, progress),
+            validation_context={"count": len(batch)},
+        )
+    finally:
+        progress.in_flight -= 1
+        progress.requests += 1
+    if completion.usage:
+        progress.tokens += completion.usage.total_tokens
+    items = sorted(result.items, key=lambda extracted: extracted.index)
+    return [response_model.model_validate(extracted.model_dump(exclude={"index"})) for extracted in items]
+
+
+def write(output, line_number, text, result):
+    output.write(json.dumps({"line": line_number, "input": text, **result}) + "\n")
+
+
+async def process(client, response_model, batch, args, progress, output, waiting, cache):
+    """
+    Extracts a batch of (key, text) and writes the result for every line waiting
+    on each key, which includes the duplicates of the text read in the meantime.
+    """
+    try:
+        outputs = [{"output": extracted.model_dump()} for extracted in
+                   await extract_batch(client, response_model, batch, args, progress)]
+    except Exception as e:
+        if len(batch) > 1:
+            # Find the lines that fail on their own, the others still get extracted
+            for single in batch:
+                await process(client, response_model, [single], args, progress, output, waiting, cache)
+            return
+        outputs = [{"error": str(e)}]
+        progress.failed += 1
+
+    for (key, _), result in zip(batch, outputs):
+        for line_number, text in waiting.pop(key):
+            write(output, line_number, text, result)
+            progress.lines += 1
+    output.flush()
+    if cache is not None:
+        entries = {key: result["output"] for (key, _), result in zip(batch, outputs) if "output" in result}
+        try:
+            cache.put(entries)
+        except sqlite3.OperationalError as e:
+            # The lines are written, they are only sent again by the next run
+            if not progress.uncached:
+                print(f"Could not cache extractions, counted as not cached from now on: {e}", file=sys.stderr)
+            progress.uncached += len(entries)
+
+
+async def extract_file(client, response_model, args, output, progress, cache=None):
+    """
+    Runs --concurrency workers over batches of the input, reading only as far as
+    they get. Lines found in `cache` are written straight away, and a text that is
+    already waiting for a request is not sent again, its line waits for that one.
+    """
+    queue = asyncio.Queue(maxsize=args.concurrency)
+    # Lines waiting per key, from the moment the key goes into a batch until its result is written
+    waiting = {}
+
+    async def worker():
+        while (batch := await queue.get()) is not None:
+            await process(client, response_model, batch, args, progress, output, waiting, cache)
+
+    async def report():
+        while True:
+            await asyncio.sleep(args.report_every)
+            progress.report()
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.concurrency)]
+    reporter = asyncio.create_task(report())
+    try:
+        batch = []
+        for line_number, text in read_lines(args.input):
+            key = cache.key(text) if cache is not None else normalize(text)
+            if key in waiting:
+                waiting[key].append((line_number, text))
+                progress.deduplicated += 1
+                continue
+            cached = cache.get(key) if cache is not None else None
+            if cached is not None:
+                write(output, line_number, text, {"output": cached, "cached": True})
+                progress.lines += 1
+                progress.cached += 1
+                continue
+
+            waiting[key] = [(line_number, text)]
+            batch.append((key, text))
+            if len(batch) == args.batch_size:
+                await queue.put(batch)
+                batch = []
+        if batch:
+            await queue.put(batch)
+        for _ in workers:
+            await queue.put(None)
+        await asyncio.gather(*workers)
+    finally:
+        reporter.cancel()
+        for task in workers:
+            task.cancel()
+
+
+async def main(args):
+    client = instructor.from_openai(AsyncOpenAI())
+    progress = Progress()
+    cache = None if args.no_cache else ExtractionCache(args.cache, UserInfo, args.model, args.cache_size * 2**20)
+    try:
+        with open(args.output, "w") as output:
+            await extract_file(client, UserInfo, args, output, progress, cache)
+    finally:
+        if cache is not None:
+            cache.close()
+    progress.report(final=True)
+    return progress
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Extract structured data from every line of a file")
+    parser.add_argument("input", help="Text file with one input per line")
+    parser.add_argument("--output", default="output.jsonl")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--batch-size", type=int, default=10, help="Lines per request")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight")
+    parser.add_argument("--retries", type=int, default=2, help="Retries per request, on validation or API errors")
+    parser.add_argument("--report-every", type=float, default=5.0, help="Seconds between progress lines")
+    parser.add_argument("--cache", default="extractions.sqlite", help="Cache file, see cache.py")
+    parser.add_argument("--cache-size", type=float, default=256, help="Megabytes the cache is kept under")
+    parser.add_argument("--no-cache", action="store_true")
+    asyncio.run(main(parser.parse_args()))
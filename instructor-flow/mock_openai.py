@@ -0,0 +1,144 @@
+"""
+A local stand-in for the OpenAI chat completions API, to run extract.py without
+an API key.
+
+    python mock_openai.py --port 8200 --latency 0.3 --invalid 0.1
+    OPENAI_BASE_URL=http://localhost:8200/v1 OPENAI_API_KEY=mock python extract.py sample.txt
+
+It answers tool calls for the list models of extract.py from the numbered texts
+in the request: integer fields get the first number in the text, "index" gets the
+text's number and string fields the words before " is ", like "John Doe is 30
+years old." Each request takes about --latency seconds. With --invalid, that
+share of first attempts leaves out a text so the response fails validation, and
+--errors fails that share of requests with a 500.
+
+    python mock_openai.py --write-sample sample.txt --lines 100000
+
+writes sentences of that form to try it with, many of them repeated.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+
+from aiohttp import web  # installed with instructor
+
+
+def _resolve(schema, definitions):
+    if "$ref" in schema:
+        return definitions[schema["$ref"].rsplit("/", 1)[-1]]
+    return schema
+
+
+def extract(schema, texts):
+    """Fills the tool's parameters schema with a list of items, one per (index, text)."""
+    definitions = schema.get("$defs", {})
+    list_field, list_schema = next(iter(schema["properties"].items()))
+    item_schema = _resolve(list_schema["items"], definitions)
+    items = []
+    for index, text in texts:
+        item = {}
+        for name, field in item_schema["properties"].items():
+            field = _resolve(field, definitions)
+            if name == "index":
+                item[name] = index
+            elif field.get("type") == "integer":
+                number = re.search(r"\d+", text)
+                item[name] = int(number.group()) if number else 0
+            else:
+                match = re.match(r"(.+?)\s+is\b", text)
+                item[name] = match.group(1) if match else text
+        items.append(item)
+    return {list_field: items}
+
+
+def create_app(latency=0.3, invalid=0.0, errors=0.0, seed=None):
+    rng = random.Random(seed)
+    stats = {"requests": 0, "invalid": 0, "errors": 0}
+
+    async def completions(request):
+        body = await request.json()
+        stats["requests"] += 1
+        await asyncio.sleep(latency * rng.lognormvariate(0, 0.25))
+        if rng.random() < errors:
+            stats["errors"] += 1
+            return web.json_response({"error": {"message": "Injected failure", "type": "server_error"}}, status=500)
+
+        tool = body["tools"][0]["function"]
+        user = next(message["content"] for message in body["messages"] if message["role"] == "user")
+        texts = [
+            (int(match.group(1)), match.group(2))
+            for match in (re.match(r"(\d+): (.*)", line) for line in user.splitlines()) if match
+        ]
+        arguments = extract(tool["parameters"], texts)
+        # Only first attempts are broken, re-asked ones carry the validation errors as a tool message
+        retried = any(message["role"] == "tool" for message in body["messages"])
+        if not retried and len(texts) > 1 and rng.random() < invalid:
+            stats["invalid"] += 1
+            arguments[next(iter(arguments))].pop()
+
+        return web.json_response({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", ""),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [{
+                        "id": f"call_{stats['requests']}",
+                        "type": "function",
+                        "function": {"name": tool["name"], "arguments": json.dumps(arguments)},
+                    }],
+                },
+            }],
+            # Roughly what a real model would use for the request
+            "usage": {
+                "prompt_tokens": len(user) // 4 + 60,
+                "completion_tokens": len(json.dumps(arguments)) // 4,
+                "total_tokens": len(user) // 4 + 60 + len(json.dumps(arguments)) // 4,
+            },
+        })
+
+    async def get_stats(request):
+        return web.json_response(stats)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", completions)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+def write_sample(path, lines, distinct=1000, seed=0):
+    """Writes `lines` sentences drawn from `distinct` different ones."""
+    rng = random.Random(seed)
+    first = ["John", "Jane", "Ama", "Kofi", "Maria", "Wei", "Olga", "Tunde", "Priya", "Lucas"]
+    last = ["Doe", "Mensah", "Smith", "Garcia", "Chen", "Ivanova", "Okafor", "Patel", "Silva", "Brown"]
+    sentences = [
+        f"{rng.choice(first)} {rng.choice(last)} is {rng.randint(18, 90)} years old." for _ in range(distinct)
+    ]
+    with open(path, "w") as f:
+        for _ in range(lines):
+            f.write(rng.choice(sentences) + "\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a mock OpenAI chat completions API for extract.py")
+    parser.add_argument("--port", type=int, default=8200)
+    parser.add_argument("--latency", type=float, default=0.3, help="Median seconds per request")
+    parser.add_argument("--invalid", type=float, default=0.0, help="Share of first attempts that fail validation")
+    parser.add_argument("--errors", type=float, default=0.0, help="Share of requests that fail with a 500")
+    parser.add_argument("--write-sample", metavar="PATH", help="Write a sample input file instead of serving")
+    parser.add_argument("--lines", type=int, default=10000)
+    parser.add_argument("--distinct", type=int, default=1000, help="Different sentences in the sample")
+    args = parser.parse_args()
+
+    if args.write_sample:
+        write_sample(args.write_sample, args.lines, args.distinct)
+    else:
+        web.run_app(create_app(args.latency, args.invalid, args.errors), port=args.port)
@@ -0,0 +1,7 @@
+from pydantic import BaseModel
+
+
+# Define your desired output structure
+class UserInfo(BaseModel):
+    name: str
+    age: int